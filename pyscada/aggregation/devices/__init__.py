@@ -17,6 +17,7 @@ try:
 except ImportError:
     driver_ok = False
 
+from datetime import datetime
 from time import time
 
 import logging
@@ -96,44 +97,43 @@ class GenericDevice(GenericHandlerDevice):
             d2 = make_aware(d2)
         output = []
 
-        if self.period_item.period_diff_quantity(d1, d2) is None:
-            logger.debug(
-                f"No period in date interval : {variable_instance} [{d1} to {d2}]"
-            )
-            agg_var.state = f"[{d1} to {d2}] < {variable_instance.device.aggregationdevice.period_factor} {variable_instance.device.aggregationdevice.period_choices[variable_instance.device.aggregationdevice.period][1]}"
-            agg_var.state = agg_var.state[0:100]
-            agg_var.save(update_fields=["state"])
-            return output
-
-        td = self.period_item.add_timedelta()
-
+        # from the first period starting at or after d1
+        # to the start of the period containing d2
         d = self.period_item.get_valid_range(d1, d2)
         if d is None:
-            agg_var.state = f"No time range found [{d1} to {d2}] {variable_instance}"
-            agg_var.state = agg_var.state[0:100]
-            agg_var.save(update_fields=["state"])
-            return output
-        [d1, d2] = d
-
-        if self.period_item.period_diff_quantity(d1, d2) is None:
             logger.debug(
-                f"No period in new date interval : {variable_instance} [{d1} to {d2}]"
+                f"No period in date interval : {variable_instance} [{d1} to {d2}]"
             )
             agg_var.state = f"[{d1} to {d2}] < {variable_instance.device.aggregationdevice.period_factor} {variable_instance.device.aggregationdevice.period_choices[variable_instance.device.aggregationdevice.period][1]}"
             agg_var.state = agg_var.state[0:100]
             agg_var.save(update_fields=["state"])
             return output
+        [d1, d2] = d
+        td = self.period_item.add_timedelta()
 
         logger.debug(f"Valid range : [{d1} to {d2}] for {variable_instance}")
         to_store = False
-        while (
+        # period starts from d1 to d2 as epoch timestamps
+        boundaries = (
+            self.period_item.get_boundaries(
+                np.arange(
+                    self.period_item.index_of(d1.timestamp()),
+                    self.period_item.index_of(d2.timestamp()) + 1,
+                )
+            )
+            / 1e6
+        ).tolist()
+        t_limit = min(
             d2.timestamp()
-            - variable_instance.device.aggregationdevice.calculation_wait_offset
-            >= (d1 + td).timestamp()
-            and d1 + td <= now()
-        ):
-            logger.debug(f"add [{d1} to {d1 + td}] for {variable_instance}")
-            td1 = d1.timestamp()
+            - variable_instance.device.aggregationdevice.calculation_wait_offset,
+            time(),
+        )
+        for td1, td2 in zip(boundaries[:-1], boundaries[1:]):
+            if td2 > t_limit:
+                break
+            d1 = datetime.fromtimestamp(td1, d2.tzinfo)
+            d_end = datetime.fromtimestamp(td2, d2.tzinfo)
+            logger.debug(f"add [{d1} to {d_end}] for {variable_instance}")
             try:
                 v_stored = Variable.objects.read_multiple(
                     variable_ids=[variable_instance.id],
@@ -143,17 +143,17 @@ class GenericDevice(GenericHandlerDevice):
             except AttributeError:
                 v_stored = {}
             if not force_write and len(v_stored) and variable_instance.id in v_stored:
-                logger.debug(f"Value already exist for {agg_var} in {d1} - {d1 + td}")
+                logger.debug(f"Value already exist for {agg_var} in {d1} - {d_end}")
                 pass
             else:
-                calc_value = self.get_value(variable_instance, d1, d1 + td)
+                calc_value = self.get_value(variable_instance, d1, d_end)
                 if calc_value is not None and variable_instance.update_values(
                     [calc_value],
                     [td1 + variable_instance.device.aggregationdevice.timestamp_offset],
                     erase_cache=False,
                 ):
                     to_store = True
-            d1 = d1 + td
+            d1 = d_end
 
         variable_instance.date_saved = now()
         output.append(variable_instance)
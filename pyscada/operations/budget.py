@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from .utils import get_setting
+
+from threading import BoundedSemaphore
+from time import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRejected(Exception):
+    """
+    a query is not evaluated, the message is the reason
+    """
+
+    pass
+
+
+class BudgetExceeded(QueryRejected):
+    """
+    a query is over its budget, the message is the reason
+    """
+
+    pass
+
+
+class QueryCancelled(Exception):
+    """
+    a query reached its deadline or was cancelled, the message is the reason
+    """
+
+    pass
+
+
+class CancelToken(object):
+    """
+    deadline and cancellation of a query_data call
+
+    The token is checked between the periods, between the slices of the trigger and
+    referenced variables reads and while waiting for the worker processes.
+    """
+
+    def __init__(self, timeout=None, event=None, t_start=None):
+        self.t_start = time() if t_start is None else t_start
+        self.timeout = timeout
+        self.deadline = None if timeout is None else self.t_start + timeout
+        self.event = event
+
+    def __str__(self):
+        return f"timeout {self.timeout}, cancelled {self.event is not None and self.event.is_set()}"
+
+    def remaining(self):
+        """
+        return the number of seconds before the deadline or None without deadline
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time())
+
+    def reason(self):
+        """
+        return why the query should stop or None
+        """
+        if self.event is not None and self.event.is_set():
+            return "query cancelled"
+        if self.deadline is not None and time() > self.deadline:
+            return f"timeout of {self.timeout} seconds reached"
+        return None
+
+    def check(self):
+        reason = self.reason()
+        if reason is not None:
+            raise QueryCancelled(reason)
+
+
+class QueryBudget(object):
+    """
+    resource budget of a query_data call
+
+    The number of periods and output points are checked before evaluating a device,
+    an over budget device is rejected or evaluated with a stride downsampling if
+    over_budget is "downsample". The number of reads of the referenced variables is
+    checked by the lookup table while the query runs.
+    """
+
+    def __init__(
+        self,
+        max_periods=None,
+        max_reads=None,
+        max_output_points=None,
+        over_budget="reject",
+    ):
+        self.max_periods = max_periods
+        self.max_reads = max_reads
+        self.max_output_points = max_output_points
+        self.over_budget = over_budget
+
+    def __str__(self):
+        return f"periods {self.max_periods}, reads {self.max_reads}, output points {self.max_output_points}, {self.over_budget}"
+
+    def limit(self, count, max_points=None, downsampling=None):
+        """
+        check the number of periods of a device
+        return the max_points and downsampling to use to stay in the budget
+        """
+        if self.max_output_points is not None and count > self.max_output_points:
+            if self.over_budget != "downsample":
+                raise BudgetExceeded(
+                    f"{int(count)} periods over the {self.max_output_points} output points budget"
+                )
+            if max_points is None or max_points > self.max_output_points:
+                max_points = self.max_output_points
+        if self.max_periods is not None and count > self.max_periods:
+            if self.over_budget != "downsample":
+                raise BudgetExceeded(
+                    f"{int(count)} periods over the {self.max_periods} periods budget"
+                )
+            if max_points is None or max_points > self.max_periods:
+                max_points = self.max_periods
+            downsampling = "stride"
+        return max_points, downsampling
+
+    def check_replay(self, count):
+        """
+        check the number of periods evaluated to rebuild the state of a device using
+        stateful expressions, the replay cannot be downsampled
+        """
+        if self.max_periods is not None and count > self.max_periods:
+            raise BudgetExceeded(
+                f"{int(count)} replayed periods over the {self.max_periods} periods budget"
+            )
+
+    def check_reads(self, reads):
+        if self.max_reads is not None and reads > self.max_reads:
+            raise BudgetExceeded(
+                f"{reads} reads over the {self.max_reads} referenced variables reads budget"
+            )
+
+
+class QueryAdmission(object):
+    """
+    limit the number of concurrent queries to protect the database
+    """
+
+    def __init__(self, max_concurrent_queries=None, timeout=10):
+        self.timeout = timeout
+        self.semaphore = None
+        if max_concurrent_queries is not None:
+            self.semaphore = BoundedSemaphore(max_concurrent_queries)
+
+    def acquire(self):
+        if self.semaphore is None:
+            return True
+        return self.semaphore.acquire(timeout=self.timeout)
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+def get_budget(**kwargs):
+    """
+    return the budget of a query from its kwargs or the settings
+    """
+    return QueryBudget(
+        max_periods=kwargs.get("max_periods", get_setting("max_periods", None)),
+        max_reads=kwargs.get("max_reads", get_setting("max_reads", None)),
+        max_output_points=kwargs.get(
+            "max_output_points", get_setting("max_output_points", None)
+        ),
+        over_budget=kwargs.get("over_budget", get_setting("over_budget", "reject")),
+    )
+
+
+admission = QueryAdmission(
+    max_concurrent_queries=get_setting("max_concurrent_queries", None),
+    timeout=get_setting("concurrent_queries_timeout", 10),
+)
@@ -0,0 +1,1077 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection
+
+from pyscada.models import Variable
+from .utils import get_setting
+from .engine import series_covers, get_series_value
+from .pushdown import query_boundary_values
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, BrokenBarrierError, Lock
+from time import time
+import numpy as np
+import hashlib
+import os
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_values(variable_id, time_min, time_max, time_in_ms=False, token=None):
+    """
+    read the [timestamp, value] list of a variable in [time_min, time_max]
+    by slices of read_slice seconds, the cancel token is checked before each slice
+    """
+    return read_multiple_values(
+        [variable_id], time_min, time_max, time_in_ms=time_in_ms, token=token
+    ).get(variable_id, [])
+
+
+def read_multiple_values(
+    variable_ids, time_min, time_max, time_in_ms=False, token=None
+):
+    """
+    read the {variable id: [timestamp, value] list} of variables in [time_min, time_max]
+    with one read_multiple by slice of read_slice seconds,
+    the cancel token is checked before each slice
+    """
+    read_slice = get_setting("read_slice", 7 * 24 * 3600)
+    values = {variable_id: [] for variable_id in variable_ids}
+    slice_min = time_min
+    while True:
+        if token is not None:
+            token.check()
+        slice_max = time_max
+        if read_slice is not None:
+            slice_max = min(time_max, slice_min + read_slice)
+        try:
+            data = Variable.objects.read_multiple(
+                variable_ids=list(variable_ids),
+                time_min=slice_min,
+                time_max=slice_max,
+                time_in_ms=time_in_ms,
+                query_first_value=False,
+            )
+        except AttributeError:
+            data = {}
+        for variable_id, variable_values in values.items():
+            slice_values = data.get(variable_id, [])
+            start = 0
+            if len(variable_values):
+                # the slices share their boundaries, the values read twice are skipped
+                # but not the duplicated timestamps of a slice
+                while (
+                    start < len(slice_values)
+                    and slice_values[start][0] <= variable_values[-1][0]
+                ):
+                    start += 1
+            variable_values.extend(slice_values[start:])
+        if slice_max >= time_max:
+            return values
+        slice_min = slice_max
+
+
+class TriggerHistory(object):
+    """
+    sorted timestamps (in seconds) of a trigger variable known in [time_min, time_max]
+    """
+
+    def __init__(self, timestamps, time_min, time_max):
+        self.timestamps = timestamps
+        self.time_min = time_min
+        self.time_max = time_max
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def covers(self, time_min):
+        return self.time_min <= time_min <= self.time_max
+
+    def overlaps(self, time_min, time_max):
+        return time_min < self.time_min <= time_max
+
+    def prepend(self, timestamps, time_min):
+        """
+        add the timestamps read before the known range and move its start to time_min
+        """
+        timestamps = timestamps[timestamps < self.time_min]
+        self.timestamps = np.concatenate((timestamps, self.timestamps))
+        self.time_min = time_min
+
+    def extend(self, timestamps, time_min, time_max):
+        """
+        replace the known timestamps from time_min with the new ones
+        and move the high-water mark to time_max
+        """
+        keep = np.searchsorted(self.timestamps, time_min, side="left")
+        self.timestamps = np.concatenate((self.timestamps[:keep], timestamps))
+        self.time_max = max(self.time_max, time_max)
+
+    def truncate(self, max_size):
+        """
+        evict the oldest timestamps, the known range start after the last evicted one
+        the duplicates of the last evicted timestamp are evicted with it
+        """
+        if len(self.timestamps) <= max_size:
+            return
+        last_evicted = self.timestamps[-max_size - 1]
+        keep = np.searchsorted(self.timestamps, last_evicted, side="right")
+        self.time_min = np.nextafter(last_evicted, np.inf)
+        self.timestamps = self.timestamps[keep:]
+
+    def get(self, time_min, time_max):
+        i_min = np.searchsorted(self.timestamps, time_min, side="left")
+        i_max = np.searchsorted(self.timestamps, time_max, side="right")
+        return self.timestamps[i_min:i_max]
+
+
+class TriggerHistoryCache(object):
+    """
+    per process cache of the trigger variables timestamps
+
+    A repeated query only reads the trigger samples newer than the cached high-water
+    mark. The tail is read again from `overlap` seconds before the high-water mark to
+    get the values saved late by the DAQ processes.
+    """
+
+    def __init__(self, max_size=100000, max_variables=100, overlap=60):
+        self.max_size = max_size
+        self.max_variables = max_variables
+        self.overlap = overlap
+        self.histories = OrderedDict()
+        self.lock = Lock()
+        self.variable_locks = {}
+        self.reads = 0
+        self.hits = 0
+        self.read_time = 0
+
+    def clear(self):
+        with self.lock:
+            self.histories.clear()
+
+    def read(self, variable_id, time_min, time_max, token=None):
+        t_start = time()
+        try:
+            values = read_values(
+                variable_id, time_min, time_max, time_in_ms=True, token=token
+            )
+        finally:
+            self.reads += 1
+            self.read_time += time() - t_start
+        if not len(values):
+            return np.array([], dtype=np.float64)
+        timestamps = np.array([d[0] for d in values], dtype=np.float64)
+        # the duplicated timestamps are kept, they are zero-length intervals
+        return np.sort(timestamps / 1000, kind="stable")
+
+    def get_timestamps(self, variable_id, time_min, time_max, token=None):
+        """
+        return the sorted timestamps in seconds of a variable in [time_min, time_max]
+        the reads stop with QueryCancelled when the cancel token fires
+        """
+        high_water_mark = min(time_max, time())
+        with self.lock:
+            variable_lock = self.variable_locks.setdefault(variable_id, Lock())
+        # the reads of different trigger variables can run concurrently
+        with variable_lock:
+            history = self.histories.get(variable_id, None)
+            if history is not None and history.overlaps(time_min, time_max):
+                # widen the known range with the head only
+                logger.debug(
+                    f"Trigger history of {variable_id} read in [{time_min}, {history.time_min}]"
+                )
+                history.prepend(
+                    self.read(variable_id, time_min, history.time_min, token),
+                    time_min,
+                )
+            if history is None or not history.covers(time_min):
+                logger.debug(
+                    f"Trigger history of {variable_id} read in [{time_min}, {time_max}]"
+                )
+                history = TriggerHistory(
+                    self.read(variable_id, time_min, time_max, token),
+                    time_min,
+                    high_water_mark,
+                )
+            elif history.time_max < time_max:
+                tail_min = max(history.time_min, history.time_max - self.overlap)
+                logger.debug(
+                    f"Trigger history of {variable_id} read in [{tail_min}, {time_max}]"
+                )
+                history.extend(
+                    self.read(variable_id, tail_min, time_max, token),
+                    tail_min,
+                    high_water_mark,
+                )
+            else:
+                self.hits += 1
+            # the result of a range larger than the cache is not truncated
+            timestamps = history.get(time_min, time_max).tolist()
+            history.truncate(self.max_size)
+            with self.lock:
+                self.histories[variable_id] = history
+                self.histories.move_to_end(variable_id)
+                while len(self.histories) > self.max_variables:
+                    evicted_id, _ = self.histories.popitem(last=False)
+                    self.variable_locks.pop(evicted_id, None)
+            return timestamps
+
+
+trigger_cache = TriggerHistoryCache(
+    max_size=get_setting("trigger_cache_size", 100000),
+    max_variables=get_setting("trigger_cache_variables", 100),
+    overlap=get_setting("trigger_cache_overlap", 60),
+)
+
+
+class StateCheckpoints(object):
+    """
+    sparse states of a calendar device using stateful expressions
+
+    The state after a completed period is kept every `interval` periods and for the
+    last period evaluated. Over max_size states, the interval is doubled and every
+    other checkpoint dropped : the seeds stay spread from the device start.
+    """
+
+    def __init__(self, interval=100, max_size=1000):
+        self.interval = interval
+        self.max_size = max_size
+        self.states = {}
+        self.latest = None
+        self.lock = Lock()
+
+    def seed(self, index):
+        """
+        return (period index, state after the period) of the last checkpoint before
+        the period index, or (-1, None) to evaluate from the device start
+        """
+        with self.lock:
+            seeds = [i for i in self.states if i < index]
+            if not len(seeds):
+                return -1, None
+            return max(seeds), self.states[max(seeds)]
+
+    def store(self, index, state, latest=False):
+        """
+        keep the state after a completed period if it is a checkpoint or the latest
+        """
+        with self.lock:
+            if index % self.interval == 0:
+                self.states[index] = state
+            elif latest and (self.latest is None or index > self.latest):
+                if self.latest is not None and self.latest % self.interval:
+                    self.states.pop(self.latest, None)
+                self.states[index] = state
+                self.latest = index
+            while len(self.states) > self.max_size:
+                self.interval *= 2
+                self.states = {
+                    i: s
+                    for i, s in self.states.items()
+                    if i % self.interval == 0 or i == self.latest
+                }
+
+    def invalidate(self, index):
+        """
+        drop the states after the periods from index
+        """
+        with self.lock:
+            self.states = {i: s for i, s in self.states.items() if i < index}
+            if self.latest is not None and self.latest >= index:
+                self.latest = None
+
+
+class CalendarWindow(dict):
+    """
+    {period start timestamp: value} of the completed periods of a calendar device
+
+    The periods ending after `settled`, the newest value of the referenced variables,
+    are not kept. `checked` is the time of the last check of the values saved late.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.settled = None
+        self.checked = None
+
+
+class CalendarWindowCache(object):
+    """
+    per process cache of the completed periods evaluated for the calendar devices
+
+    Polling dashboards query an overlapping window every few seconds : the completed
+    periods are kept by period start timestamp, only the new and the open periods
+    are evaluated. A period is completed when its end is older than `delay` seconds
+    and than the newest value of the referenced variables. The periods changed by
+    the values saved late are dropped, see OperationsDataSource.check_window.
+    """
+
+    def __init__(
+        self,
+        max_size=100000,
+        max_devices=100,
+        delay=60,
+        checkpoint_interval=100,
+        max_checkpoints=1000,
+    ):
+        self.max_size = max_size
+        self.max_devices = max_devices
+        self.delay = delay
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.windows = OrderedDict()
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.windows.clear()
+
+    def get_key(self, device):
+        # any change of the device configuration use a new window
+        return (
+            device.id,
+            device.operationsdevice.master_operation,
+            device.operationsdevice.start_from.timestamp(),
+            device.operationsdevice.period,
+            device.operationsdevice.period_factor,
+        )
+
+    def get_window(self, device):
+        """
+        return the CalendarWindow of a device
+        """
+        return self.get_keyed_window(self.get_key(device), CalendarWindow)
+
+    def get_states(self, device):
+        """
+        return the state checkpoints of a device using stateful expressions
+        """
+        return self.get_keyed_window(
+            self.get_key(device) + ("states",),
+            lambda: StateCheckpoints(self.checkpoint_interval, self.max_checkpoints),
+        )
+
+    def get_keyed_window(self, key, factory=dict):
+        with self.lock:
+            if key not in self.windows:
+                self.windows[key] = factory()
+            self.windows.move_to_end(key)
+            while len(self.windows) > self.max_devices:
+                self.windows.popitem(last=False)
+            return self.windows[key]
+
+    def lookup(self, window, t_from):
+        """
+        return True and the value of the period starting at t_from if it is kept
+        """
+        with self.lock:
+            if t_from in window:
+                return True, window[t_from]
+            return False, None
+
+    def get_values(self, window, starts):
+        """
+        return the {period start timestamp: value} of the kept periods of starts
+        """
+        with self.lock:
+            return {t: window[t] for t in starts if t in window}
+
+    def store(self, window, t_from, t_to, value):
+        """
+        keep the value of a completed period, return True if stored
+        """
+        if t_to > time() - self.delay or (
+            window.settled is not None and t_to > window.settled
+        ):
+            # the period is not completed
+            return False
+        self.keep(window, t_from, value)
+        return True
+
+    def keep(self, window, t_from, value):
+        """
+        keep the value of a period, the first stored periods are evicted over max_size
+        """
+        with self.lock:
+            window[t_from] = value
+            while len(window) > self.max_size:
+                del window[next(iter(window))]
+
+    def invalidate(self, device, t_from, index):
+        """
+        drop the periods of a device from the period of index starting at t_from
+        """
+        window = self.get_window(device)
+        states = self.get_states(device)
+        with self.lock:
+            for t in [t for t in window if t >= t_from]:
+                del window[t]
+        states.invalidate(index)
+
+
+window_cache = CalendarWindowCache(
+    max_size=get_setting("window_cache_size", 100000),
+    max_devices=get_setting("window_cache_devices", 100),
+    delay=get_setting("window_cache_delay", 60),
+    checkpoint_interval=get_setting("state_checkpoint_interval", 100),
+    max_checkpoints=get_setting("state_checkpoints", 1000),
+)
+
+
+class BoundaryTableCache(object):
+    """
+    per process cache of the month and year period starts
+
+    The starts of each (start_from, timezone, period, period_factor) are kept in a
+    contiguous int64 array of epoch microseconds, extended when an index outside of
+    it is used. The tables of more than max_size periods are not kept.
+    """
+
+    # periods added on each side of an extension
+    margin = 12
+
+    def __init__(self, max_size=12000, max_tables=1000):
+        self.max_size = max_size
+        self.max_tables = max_tables
+        self.tables = OrderedDict()
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+
+    def get_table(self, key, i_min, i_max, compute):
+        """
+        return the (first index, starts) table of a key covering the indices from
+        i_min to i_max, None if it is too large
+        compute returns the starts of an array of indices
+        """
+        with self.lock:
+            table = self.tables.get(key, None)
+            if table is not None:
+                self.tables.move_to_end(key)
+        if table is not None:
+            first, starts = table
+            if first <= i_min and i_max < first + len(starts):
+                return table
+            i_min = min(i_min, first)
+            i_max = max(i_max, first + len(starts) - 1)
+        i_min -= self.margin
+        i_max += self.margin
+        if i_max - i_min + 1 > self.max_size:
+            return None
+        if table is None:
+            starts = compute(np.arange(i_min, i_max + 1, dtype=np.int64))
+        else:
+            starts = np.concatenate(
+                [
+                    compute(np.arange(i_min, first, dtype=np.int64)),
+                    starts,
+                    compute(np.arange(first + len(starts), i_max + 1, dtype=np.int64)),
+                ]
+            )
+        # replaced at once, the arrays are never changed in place
+        table = (i_min, starts)
+        with self.lock:
+            self.tables[key] = table
+            self.tables.move_to_end(key)
+            while len(self.tables) > self.max_tables:
+                self.tables.popitem(last=False)
+        return table
+
+
+boundary_cache = BoundaryTableCache(
+    max_size=get_setting("boundary_table_size", 12000),
+    max_tables=get_setting("boundary_tables", 1000),
+)
+
+
+class ReadExecutor(object):
+    """
+    worker threads reading the datasources concurrently
+
+    The threads and their database connections are reused by the reads of all the
+    windows of a prefetch, the connections are closed once at shutdown.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def map(self, fn, *iterables):
+        return self.executor.map(fn, *iterables)
+
+    def shutdown(self):
+        # each close waits for the others, so each worker thread runs one of them
+        barrier = Barrier(self.max_workers)
+
+        def close(i):
+            try:
+                barrier.wait(timeout=10)
+            except BrokenBarrierError:
+                pass
+            connection.close()
+
+        try:
+            list(self.executor.map(close, range(self.max_workers)))
+        finally:
+            self.executor.shutdown()
+
+
+class VariableLookupTable(object):
+    """
+    memoize the referenced variables lookups during a query_data call
+
+    The table is shared by all the devices evaluated in the same query, each distinct
+    (variable, time_min, time_max, time_max_excluded, use_date_saved) lookup hit the
+    storage once. The value and the timestamp query types share the same lookup.
+    """
+
+    def __init__(self):
+        self.variables = {}
+        self.values = {}
+        self.series = {}
+        self.hits = 0
+        self.reads = 0
+        self.variable_reads = {}
+        self.read_time = 0
+        self.token = None
+        self.aggregated = {}
+        self.executor = None
+
+    def __str__(self):
+        return f"{len(self.variables)} variables, {self.reads} reads, {self.hits} hits"
+
+    def get_stats(self):
+        return {
+            "reads": self.reads,
+            "hits": self.hits,
+            "variable_reads": dict(self.variable_reads),
+            "read_time": self.read_time,
+        }
+
+    def count_read(self, variable_id, t_start):
+        self.reads += 1
+        self.variable_reads[variable_id] = self.variable_reads.get(variable_id, 0) + 1
+        self.read_time += time() - t_start
+
+    def get_variable(self, variable_id):
+        if variable_id not in self.variables:
+            try:
+                self.variables[variable_id] = Variable.objects.get(id=variable_id)
+            except Variable.DoesNotExist:
+                logger.warning(
+                    f"Cannot evaluate operations device. Variable with id {variable_id} does not exist."
+                )
+                self.variables[variable_id] = None
+        return self.variables[variable_id]
+
+    def get_variables(self, variable_ids):
+        """
+        get the variables not known yet with one query
+        """
+        variable_ids = [v_id for v_id in variable_ids if v_id not in self.variables]
+        if not len(variable_ids):
+            return
+        for v in Variable.objects.filter(id__in=variable_ids):
+            self.variables[v.id] = v
+
+    def get_prev_value(
+        self, variable_id, time_min, time_max, time_max_excluded, use_date_saved
+    ):
+        """
+        return the [value, timestamp] of the last value of a variable in the range
+        or None if there is no value
+        """
+        key = (variable_id, time_min, time_max, time_max_excluded, use_date_saved)
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+        result = None
+        series = self.series.get(variable_id, None)
+        if (
+            series is not None
+            and not use_date_saved
+            and series_covers(series, time_min, time_max)
+        ):
+            self.hits += 1
+            result = get_series_value(series, time_min, time_max, time_max_excluded)
+            self.values[key] = result
+            return result
+        v = self.get_variable(variable_id)
+        if v is not None:
+            if self.token is not None:
+                self.token.check()
+            t_start = time()
+            if v.query_prev_value(
+                time_min=time_min,
+                time_max=time_max,
+                use_date_saved=use_date_saved,
+                time_max_excluded=time_max_excluded,
+            ):
+                result = [v.prev_value, v.timestamp_old]
+            self.count_read(variable_id, t_start)
+        self.values[key] = result
+        return result
+
+    def prefetch_boundaries(self, variable_id, periods, time_max_excluded=True):
+        """
+        resolve the lookups of a variable for many (time_min, time_max) periods
+        with one query returning the last value before each period end
+        return False if the storage of the variable does not allow it
+        """
+        periods = self.get_unresolved(variable_id, periods, time_max_excluded)
+        series = self.series.get(variable_id, None)
+        if not len(periods) or (
+            series is not None
+            and series_covers(
+                series, min(p[0] for p in periods), max(p[1] for p in periods)
+            )
+        ):
+            return True
+        v = self.get_variable(variable_id)
+        if v is None:
+            return False
+        t_start = time()
+        values = query_boundary_values(
+            v,
+            [p[1] for p in periods],
+            time_min=min(p[0] for p in periods),
+            time_max_excluded=time_max_excluded,
+            token=self.token,
+        )
+        if values is None:
+            return False
+        self.count_read(variable_id, t_start)
+        for time_min, time_max in periods:
+            result = values.get(time_max, None)
+            if result is not None and result[1] < time_min:
+                # no value in the period
+                result = None
+            self.values[(variable_id, time_min, time_max, time_max_excluded, False)] = (
+                result
+            )
+        return True
+
+    def get_unresolved(self, variable_id, periods, time_max_excluded=True):
+        """
+        return the periods whose lookup of a variable is not resolved yet
+        """
+        return [
+            p
+            for p in periods
+            if (variable_id, p[0], p[1], time_max_excluded, False) not in self.values
+            and (
+                not time_max_excluded
+                or (variable_id, p[0], p[1]) not in self.aggregated
+            )
+        ]
+
+    def prefetch_periods(
+        self,
+        variable_ids,
+        periods,
+        max_range=86400,
+        pushdown=True,
+        time_max_excluded=True,
+    ):
+        """
+        resolve the lookups of variables for many (time_min, time_max) periods
+        with one boundaries query per variable when its storage allows it,
+        the other variables are read per datasource by windows of at most max_range
+        seconds of contiguous periods, the datasources are read concurrently
+        """
+        to_read = [
+            v_id
+            for v_id in set(variable_ids)
+            if not pushdown
+            or not self.prefetch_boundaries(v_id, periods, time_max_excluded)
+        ]
+        # a longer period is resolved by one lookup instead of reading all its values
+        periods = sorted(p for p in periods if max_range and p[1] - p[0] <= max_range)
+        self.get_variables(to_read)
+        datasources = set(
+            self.get_variable(v_id).datasource_id
+            for v_id in to_read
+            if self.get_variable(v_id) is not None
+        )
+        executor = None
+        if len(datasources) > 1 and self.executor is None:
+            # the windows share the worker threads and their connections
+            executor = self.executor = ReadExecutor(len(datasources))
+        try:
+            self.prefetch_windows(to_read, periods, max_range, time_max_excluded)
+        finally:
+            if executor is not None:
+                self.executor = None
+                executor.shutdown()
+
+    def prefetch_windows(self, variable_ids, periods, max_range, time_max_excluded):
+        """
+        read the variables by windows of at most max_range seconds of the sorted
+        periods and resolve their lookups, see prefetch_periods
+        """
+        i = 0
+        while len(variable_ids) and i < len(periods):
+            t_min, t_max = periods[i]
+            j = i + 1
+            while j < len(periods) and max(t_max, periods[j][1]) - t_min <= max_range:
+                t_max = max(t_max, periods[j][1])
+                j += 1
+            window = periods[i:j]
+            i = j
+            if len(window) < 2:
+                continue
+            unresolved = {}
+            for v_id in variable_ids:
+                v_periods = self.get_unresolved(v_id, window, time_max_excluded)
+                if len(v_periods):
+                    unresolved[v_id] = v_periods
+            if not len(unresolved):
+                continue
+            # the series read for the window are dropped once the lookups are resolved
+            kept = {v: self.series[v] for v in unresolved if v in self.series}
+            try:
+                self.prefetch_multiple(unresolved.keys(), t_min, t_max)
+                for v_id, v_periods in unresolved.items():
+                    for time_min, time_max in v_periods:
+                        self.values[
+                            (v_id, time_min, time_max, time_max_excluded, False)
+                        ] = get_series_value(
+                            self.series[v_id], time_min, time_max, time_max_excluded
+                        )
+            finally:
+                for v_id in unresolved:
+                    self.series.pop(v_id, None)
+                self.series.update(kept)
+
+    def get_aggregated_value(self, variable_id, time_min, time_max):
+        """
+        return True and the last value of a variable in [time_min, time_max[
+        if it was read from an aggregation variable
+        """
+        key = (variable_id, time_min, time_max)
+        if key in self.aggregated:
+            self.hits += 1
+            return True, self.aggregated[key]
+        return False, None
+
+    def prefetch_aggregated(
+        self,
+        variable_id,
+        aggregation_id,
+        periods,
+        time_min,
+        time_max,
+        timestamp_offset=0,
+    ):
+        """
+        read the last values of a variable in the periods inside [time_min, time_max]
+        from an aggregation variable of type last, the aggregation periods divide them
+        """
+        periods = [
+            p
+            for p in periods
+            if time_min <= p[0]
+            and p[1] <= time_max
+            and (variable_id, p[0], p[1]) not in self.aggregated
+        ]
+        if not len(periods):
+            return
+        t_start = time()
+        try:
+            values = read_values(
+                aggregation_id,
+                min(p[0] for p in periods) + timestamp_offset,
+                max(p[1] for p in periods) + timestamp_offset,
+                token=self.token,
+            )
+        finally:
+            self.count_read(aggregation_id, t_start)
+        # start timestamps of the aggregation periods
+        timestamps = np.round(
+            np.array([v[0] for v in values], dtype=np.float64) - timestamp_offset, 3
+        )
+        for t_from, t_to in periods:
+            i = np.searchsorted(timestamps, t_to, side="left")
+            value = None
+            if i > 0 and timestamps[i - 1] >= t_from:
+                value = values[i - 1][1]
+            self.aggregated[(variable_id, t_from, t_to)] = value
+
+    def prefetch(self, variable_id, time_min, time_max):
+        """
+        read the values of a variable in [time_min, time_max] with one batched read,
+        the lookups inside this range are then resolved from memory
+        """
+        self.prefetch_multiple([variable_id], time_min, time_max)
+        return self.series[variable_id]
+
+    def prefetch_multiple(self, variable_ids, time_min, time_max):
+        """
+        read the values of variables in [time_min, time_max] with one batched read
+        per datasource, the datasources are read concurrently
+        """
+        groups = {}
+        to_read = [
+            v_id
+            for v_id in set(variable_ids)
+            if v_id not in self.series
+            or not series_covers(self.series[v_id], time_min, time_max)
+        ]
+        self.get_variables(to_read)
+        for v_id in to_read:
+            v = self.get_variable(v_id)
+            if v is None:
+                self.set_series(v_id, time_min, time_max, [])
+            else:
+                groups.setdefault(v.datasource_id, []).append(v_id)
+        if not len(groups):
+            return
+        t_start = time()
+        try:
+            if len(groups) == 1:
+                results = [
+                    self.read_group(ids, time_min, time_max) for ids in groups.values()
+                ]
+            else:
+                logger.debug(
+                    f"Reading {len(to_read)} variables from {len(groups)} datasources"
+                )
+                executor = self.executor
+                if executor is None:
+                    executor = ReadExecutor(len(groups))
+                try:
+                    results = list(
+                        executor.map(
+                            lambda ids: self.read_group(ids, time_min, time_max),
+                            groups.values(),
+                        )
+                    )
+                finally:
+                    if executor is not self.executor:
+                        executor.shutdown()
+        finally:
+            # the datasources are read at the same time, count the elapsed time once
+            self.read_time += time() - t_start
+        for values in results:
+            self.reads += 1
+            for v_id, v_values in values.items():
+                self.variable_reads[v_id] = self.variable_reads.get(v_id, 0) + 1
+                self.set_series(v_id, time_min, time_max, v_values)
+
+    def read_group(self, variable_ids, time_min, time_max):
+        """
+        read the values of variables of the same datasource
+        """
+        return read_multiple_values(variable_ids, time_min, time_max, token=self.token)
+
+    def set_series(self, variable_id, time_min, time_max, values):
+        self.series[variable_id] = [
+            time_min,
+            time_max,
+            np.array([v[0] for v in values], dtype=np.float64),
+            [v[1] for v in values],
+        ]
+
+
+# type codes of the shared values
+FLOAT, INT, BOOL = 0, 1, 2
+
+
+def get_type_code(value):
+    """
+    return the type code of a numeric value or None if it cannot be shared
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return BOOL
+    if isinstance(value, (int, np.integer)):
+        return INT
+    if value is None or isinstance(value, (float, np.floating)):
+        return FLOAT
+    return None
+
+
+class SharedSeriesCache(object):
+    """
+    cache of the completed periods of the calendar devices shared by the processes of a host
+
+    Each device window is published in a .npy file of the directory holding a
+    [period start timestamps, values, type codes] float64 array sorted by timestamp,
+    None values are stored as NaN. The files are written to a temporary file and
+    renamed to be published atomically, the readers memory-map them. The new periods
+    of a window are published at most once every `interval` seconds, the least
+    recently published files are removed when the directory size exceeds max_size bytes.
+    The loaded series and the publication states of the least recently used windows
+    are dropped over max_windows windows.
+    """
+
+    def __init__(
+        self, directory=None, max_size=100 * 1024 * 1024, interval=10, max_windows=100
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.interval = interval
+        self.max_windows = max_windows
+        self.series = OrderedDict()
+        self.pending = OrderedDict()
+        self.published_at = OrderedDict()
+        self.evicted_at = 0
+        self.lock = Lock()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".npy")
+
+    def get(self, key):
+        """
+        return the memory-mapped series of a window key or None
+        """
+        if self.directory is None:
+            return None
+        path = self.get_path(key)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if key in self.series and self.series[key][0] == mtime:
+                self.series.move_to_end(key)
+                return self.series[key][1]
+            try:
+                series = np.load(path, mmap_mode="r")
+            except (OSError, ValueError) as e:
+                logger.debug(f"Cannot load shared series {path} : {e}")
+                return None
+            self.series[key] = (mtime, series)
+            self.series.move_to_end(key)
+            self.trim(self.series)
+            return series
+
+    def trim(self, windows):
+        # drop the least recently used windows, called with the lock held
+        while len(windows) > self.max_windows:
+            windows.popitem(last=False)
+
+    def lookup(self, series, t_from):
+        """
+        return True and the value of the period starting at t_from if it is in the series
+        """
+        if series is None or not series.shape[1]:
+            return False, None
+        i = np.searchsorted(series[0], t_from)
+        if i < series.shape[1] and series[0][i] == t_from:
+            value = series[1][i]
+            if np.isnan(value):
+                return True, None
+            type_code = series[2][i] if series.shape[0] > 2 else FLOAT
+            if type_code == INT:
+                return True, int(value)
+            if type_code == BOOL:
+                return True, bool(value)
+            return True, float(value)
+        return False, None
+
+    def publish(self, key, periods):
+        """
+        publish the numeric values of the new {period start: value} of a window
+        the periods are kept pending until the next publication of the window
+        """
+        if self.directory is None or not len(periods):
+            return
+        with self.lock:
+            pending = self.pending.setdefault(key, {})
+            pending.update(periods)
+            self.pending.move_to_end(key)
+            self.trim(self.pending)
+            if time() - self.published_at.get(key, 0) < self.interval:
+                return
+            del self.pending[key]
+            self.published_at[key] = time()
+            self.published_at.move_to_end(key)
+            self.trim(self.published_at)
+        rows = []
+        for t_from, value in pending.items():
+            type_code = get_type_code(value)
+            if type_code is not None:
+                rows.append((t_from, np.nan if value is None else value, type_code))
+        if not len(rows):
+            return
+        series = np.array(sorted(rows), dtype=np.float64).T
+        published = self.get(key)
+        if published is not None and published.shape[1]:
+            if published.shape[0] < 3:
+                published = np.vstack((published, np.zeros(published.shape[1])))
+            if series[0][0] > published[0][-1]:
+                # the new periods follow the published ones
+                series = np.concatenate((published, series), axis=1)
+            else:
+                known = np.isin(published[0], series[0], invert=True)
+                series = np.concatenate((published[:, known], series), axis=1)
+                series = series[:, np.argsort(series[0], kind="stable")]
+        if not self.write(key, series):
+            return
+        if time() - self.evicted_at >= self.interval:
+            self.evicted_at = time()
+            self.evict()
+
+    def write(self, key, series):
+        """
+        publish the series of a window key atomically, return True if written
+        """
+        path = self.get_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, series)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Cannot publish shared series {path} : {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    def invalidate(self, key, t_from):
+        """
+        drop the pending and published periods of a window starting from t_from
+        """
+        if self.directory is None:
+            return
+        with self.lock:
+            pending = self.pending.get(key, {})
+            for t in [t for t in pending if t >= t_from]:
+                del pending[t]
+        published = self.get(key)
+        if published is not None and published.shape[1] and published[0][-1] >= t_from:
+            self.write(key, np.array(published[:, published[0] < t_from]))
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(f[1] for f in files)
+        for mtime, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except FileNotFoundError:
+                pass
+
+
+shared_cache = SharedSeriesCache(
+    directory=get_setting("shared_cache_dir", None),
+    max_size=get_setting("shared_cache_size", 100 * 1024 * 1024),
+    interval=get_setting("shared_cache_interval", 10),
+    max_windows=get_setting("shared_cache_windows", 100),
+)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+single-flight coalescing of the identical concurrent queries
+
+When many clients open the same view at the same time, they send the same query.
+The first call evaluates it, the identical calls received before its end wait for
+it and get a copy of its result.
+"""
+from __future__ import unicode_literals
+
+from threading import Event, Lock
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# kwargs of a query which cannot be shared with another call
+PRIVATE_KWARGS = ["cancel", "lookup_table", "token", "admitted", "explain"]
+
+
+def get_query_key(quantity, order, kwargs):
+    """
+    return the normalized parameters of a query or None if it cannot be coalesced
+    """
+    key = [("quantity", quantity), ("order", order)]
+    for name, value in sorted(kwargs.items()):
+        if name in PRIVATE_KWARGS:
+            return None
+        if name == "variable_ids":
+            try:
+                value = tuple(sorted(set(value)))
+            except TypeError:
+                return None
+        try:
+            hash(value)
+        except TypeError:
+            return None
+        key.append((name, value))
+    return tuple(key)
+
+
+def copy_result(result):
+    """
+    return a copy of a query result, the series lists can be changed by the caller
+    """
+    if not isinstance(result, dict):
+        return result
+    return {
+        key: list(item) if isinstance(item, list) else item
+        for key, item in result.items()
+    }
+
+
+class Flight(object):
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+
+# result of an async query cancelled by its caller, the waiting calls run it again
+RETRY = object()
+
+
+class SingleFlight(object):
+    """
+    run one call at a time for each key, the calls with the same key made during
+    this call wait for it and share its result
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.futures = {}
+        self.lock = Lock()
+        self.coalesced = 0
+
+    def do(self, key, function):
+        with self.lock:
+            flight = self.flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.debug(f"Waiting for the identical query in flight {key}")
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy_result(flight.result)
+        try:
+            flight.result = function()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+    async def ado(self, key, function):
+        """
+        coroutine version of do, the calls are coalesced in each event loop
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), key)
+        while True:
+            future = self.futures.get(key, None)
+            if future is None:
+                break
+            self.coalesced += 1
+            logger.debug(f"Waiting for the identical query in flight {key[1]}")
+            result = await asyncio.shield(future)
+            if result is not RETRY:
+                return copy_result(result)
+        future = loop.create_future()
+        self.futures[key] = future
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            future.set_result(RETRY)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved by the waiting calls if any
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.futures[key]
+        return result
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding of the query_data output by byte chunks
+
+The numbers of a chunk are formatted at once from NumPy buffers : each number is
+written right-aligned in a fixed width field of ASCII digits with a fixed number
+of decimals, the leading zeros are replaced by spaces (valid JSON whitespace).
+The series with booleans or strings values are encoded by the json module.
+"""
+from __future__ import unicode_literals
+
+import numpy as np
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SPACE = ord(" ")
+# ASCII digits of 0000 to 9999, 4 bytes each
+QUADS = np.frombuffer(
+    "".join(f"{i:04d}" for i in range(10000)).encode(), dtype=np.uint32
+)
+POWERS = 10 ** np.arange(1, 19, dtype=np.int64)
+NUMBER_TYPES = {int, float, type(None), np.float64, np.float32, np.int64, np.int32}
+
+
+def format_numbers(values, decimals=0):
+    """
+    return a (n, width) uint8 array of the values as JSON numbers, NaN values are null
+    or None if a value does not fit in an int64 with its decimals
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    null = ~np.isfinite(values)
+    has_null = null.any()
+    scaled = np.abs(values) * 10**decimals
+    if has_null:
+        scaled[null] = 0
+    scaled = np.round(scaled)
+    if n and scaled.max() >= 1e18:
+        return None
+    scaled = scaled.astype(np.int64)
+    # number of digits of each number, at least one before the decimals
+    ndigits = np.searchsorted(POWERS, scaled, side="right") + 1
+    np.maximum(ndigits, decimals + 1, out=ndigits)
+    width = int(ndigits.max()) if n else decimals + 1
+
+    # zero padded digits, 4 by 4
+    quads = (width + 3) // 4
+    digits = np.empty((n, quads), dtype=np.uint32)
+    x = scaled
+    for j in range(quads - 1, -1, -1):
+        q = x // 10000
+        digits[:, j] = QUADS[x - q * 10000]
+        x = q
+    digits = digits.view(np.uint8)[:, 4 * quads - width :]
+
+    int_digits = width - decimals
+    field = np.empty((n, width + 2 if decimals else width + 1), dtype=np.uint8)
+    field[:, 0] = SPACE
+    field[:, 1 : 1 + int_digits] = digits[:, :int_digits]
+    if decimals:
+        field[:, 1 + int_digits] = ord(".")
+        field[:, 2 + int_digits :] = digits[:, int_digits:]
+    # blank the leading zeros, grouped by number of digits
+    first = width - ndigits
+    for blanks in np.flatnonzero(np.bincount(first)):
+        if blanks:
+            field[first == blanks, 1 : 1 + blanks] = SPACE
+    rows = np.flatnonzero((values < 0) & (scaled > 0))
+    field[rows, first[rows]] = ord("-")
+    if has_null:
+        if field.shape[1] < 4:
+            field = np.hstack(
+                [np.full((n, 4 - field.shape[1]), SPACE, np.uint8), field]
+            )
+        field[null] = SPACE
+        field[null, :4] = np.frombuffer(b"null", dtype=np.uint8)
+    return field
+
+
+def to_arrays(data):
+    """
+    return the timestamps array and the values of a [[timestamp, value], ...] list
+    the values are a float64 array with NaN for None if they are all numbers
+    """
+    timestamps = np.fromiter((d[0] for d in data), dtype=np.float64, count=len(data))
+    values = [d[1] for d in data]
+    if set(map(type, values)) <= NUMBER_TYPES:
+        values = np.array(values, dtype=np.float64)
+    return timestamps, values
+
+
+def encode_rows(timestamps, values, time_decimals=3, decimals=6):
+    """
+    return the bytes of the [timestamp, value] rows separated by commas
+    """
+    t_field = format_numbers(timestamps, time_decimals)
+    v_field = None
+    if isinstance(values, np.ndarray):
+        v_field = format_numbers(values, decimals)
+    if t_field is None or v_field is None:
+        # booleans, strings or too large numbers
+        if isinstance(values, np.ndarray):
+            values = [None if np.isnan(v) else v for v in values.tolist()]
+        return json.dumps([list(d) for d in zip(timestamps.tolist(), values)])[
+            1:-1
+        ].encode()
+    n = len(timestamps)
+    t_width = t_field.shape[1]
+    rows = np.empty((n, t_width + v_field.shape[1] + 4), dtype=np.uint8)
+    rows[:, 0] = ord("[")
+    rows[:, 1 : 1 + t_width] = t_field
+    rows[:, 1 + t_width] = ord(",")
+    rows[:, 2 + t_width : -2] = v_field
+    rows[:, -2] = ord("]")
+    rows[:, -1] = ord(",")
+    return rows.tobytes()[:-1]
+
+
+def encode_series(timestamps, values, time_decimals=3, decimals=6, chunk_size=8192):
+    """
+    yield the JSON byte chunks of a series given by its timestamps and values
+    """
+    yield b"["
+    for start in range(0, len(timestamps), chunk_size):
+        if start:
+            yield b","
+        yield encode_rows(
+            timestamps[start : start + chunk_size],
+            values[start : start + chunk_size],
+            time_decimals,
+            decimals,
+        )
+    yield b"]"
+
+
+def encode_output(output, time_decimals=3, decimals=6, chunk_size=8192):
+    """
+    yield the JSON byte chunks of a query_data output
+    the series of the variables are encoded by chunks of chunk_size points,
+    the other items by json
+    """
+    yield b"{"
+    first = True
+    for key, item in output.items():
+        if not first:
+            yield b","
+        first = False
+        yield json.dumps(str(key)).encode() + b":"
+        if isinstance(key, int) and isinstance(item, list):
+            # variable id : [[timestamp, value], ...]
+            timestamps, values = to_arrays(item)
+            yield from encode_series(
+                timestamps, values, time_decimals, decimals, chunk_size
+            )
+        else:
+            yield json.dumps(item).encode()
+    yield b"}"
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+evaluation of the operations on prefetched series of the referenced variables
+
+This module does not use the database, the functions can run in worker processes.
+A series is a [time_min, time_max, timestamps, values] list with the sorted
+timestamps (numpy array in seconds) and the values of a variable in [time_min, time_max].
+"""
+from __future__ import unicode_literals
+
+import numpy as np
+import simpleeval
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MissingInput(LookupError):
+    """
+    a value is needed outside the prefetched series
+    """
+
+    pass
+
+
+def series_covers(series, time_min, time_max):
+    return series[0] <= time_min and time_max <= series[1]
+
+
+def get_series_value(series, time_min, time_max, time_max_excluded=True):
+    """
+    return the [value, timestamp] of the last value of a series in the range
+    or None if there is no value
+    """
+    timestamps = series[2]
+    i_min = np.searchsorted(timestamps, time_min, side="left")
+    i_max = np.searchsorted(
+        timestamps, time_max, side="left" if time_max_excluded else "right"
+    )
+    if i_max > i_min:
+        return [series[3][i_max - 1], float(timestamps[i_max - 1])]
+    return None
+
+
+def get_series_slice(series, time_min, time_max):
+    """
+    return the part of a series in [time_min, time_max]
+    """
+    timestamps = series[2]
+    i_min = np.searchsorted(timestamps, time_min, side="left")
+    i_max = np.searchsorted(timestamps, time_max, side="right")
+    return [time_min, time_max, timestamps[i_min:i_max], series[3][i_min:i_max]]
+
+
+def get_change_points(keys):
+    """
+    return the sorted indices where a key differs from the previous one
+    """
+    if len(keys) < 2:
+        return np.array([], dtype=int)
+    return np.flatnonzero(keys[1:] != keys[:-1]) + 1
+
+
+def get_last_indices(timestamps, time_mins, time_maxs):
+    """
+    return the index of the last sample in each [time_min, time_max[ period or -1
+    """
+    i_min = np.searchsorted(timestamps, time_mins, side="left")
+    i_max = np.searchsorted(timestamps, time_maxs, side="left")
+    return np.where(i_max > i_min, i_max - 1, -1)
+
+
+class ChunkInput(object):
+    """
+    values of a variable lookup for all the periods of a chunk
+
+    keys holds for each period the code of the resolved value (or the sample index
+    for the timestamp lookups), -1 without value, to find the runs of periods
+    with the same input.
+    """
+
+    def __init__(self, series, time_mins, time_maxs, query_type="value"):
+        self.indices = get_last_indices(series[2], time_mins, time_maxs)
+        self.series = series
+        self.query_type = query_type
+        if query_type == "value":
+            codes = {}
+            try:
+                value_codes = np.array(
+                    [codes.setdefault(v, len(codes)) for v in series[3]], dtype=int
+                )
+            except TypeError:
+                # unhashable values, compare the samples
+                value_codes = np.arange(len(series[3]))
+            if len(value_codes):
+                self.keys = np.where(
+                    self.indices >= 0, value_codes[np.maximum(self.indices, 0)], -1
+                )
+            else:
+                # no value in the chunk
+                self.keys = self.indices
+        else:
+            self.keys = self.indices
+        self.changes = get_change_points(self.keys)
+
+    def get(self, k):
+        i = self.indices[k]
+        if i < 0:
+            return None
+        if self.query_type == "timestamp":
+            return float(self.series[2][i])
+        return self.series[3][i]
+
+    def next_change(self, k):
+        """
+        return the index of the first period after k with a different input or None
+        """
+        j = np.searchsorted(self.changes, k, side="right")
+        if j < len(self.changes):
+            return int(self.changes[j])
+        return None
+
+
+# functions using the state carried from a period to the next one
+STATEFUL_FUNCTIONS = ["prev(", "cumsum("]
+
+
+def is_stateful(master_operation):
+    return any(f in master_operation for f in STATEFUL_FUNCTIONS)
+
+
+class PeriodState(object):
+    """
+    state of the stateful expressions at the start of a period :
+    the result of the previous period and the running totals of the cumsum calls,
+    in the order of the calls in the expression
+    """
+
+    def __init__(self, prev=None, totals=()):
+        self.prev = prev
+        self.totals = tuple(totals)
+        self.new_totals = []
+
+    def prev_result(self, default=None):
+        return default if self.prev is None else self.prev
+
+    def cumsum(self, value):
+        i = len(self.new_totals)
+        total = self.totals[i] if i < len(self.totals) else 0
+        if value is not None:
+            total += value
+        self.new_totals.append(total)
+        return total
+
+    def next(self, result):
+        """
+        return the state at the start of the next period
+        """
+        totals = tuple(self.new_totals) + self.totals[len(self.new_totals) :]
+        return PeriodState(result, totals)
+
+    def snapshot(self):
+        return (self.prev, self.totals)
+
+
+def evaluate_chunk(master_operation, periods, series, functions=None):
+    """
+    evaluate a master operation for each (time_min, time_max) period of a chunk
+    using the prefetched series of the referenced variables and the scalar functions
+    return the list of values or None if a value is missing in the series
+
+    The expression is evaluated once for each run of periods where the lookups
+    done by the previous evaluation resolve to the same values.
+    """
+    time_mins = np.array([p[0] for p in periods], dtype=np.float64)
+    time_maxs = np.array([p[1] for p in periods], dtype=np.float64)
+    inputs = {}
+    calls = set()
+    current = [0]
+
+    def variable(variable_id, use_date_saved=False, query_type="value"):
+        key = (variable_id, query_type)
+        if key not in inputs:
+            if (
+                variable_id not in series
+                or use_date_saved
+                or not series_covers(
+                    series[variable_id], time_mins.min(), time_maxs.max()
+                )
+            ):
+                raise MissingInput(variable_id)
+            if query_type not in ["value", "timestamp"]:
+                logger.warning(f"Operation query type unknown : {query_type}")
+                return None
+            inputs[key] = ChunkInput(
+                series[variable_id], time_mins, time_maxs, query_type
+            )
+        calls.add(key)
+        return inputs[key].get(current[0])
+
+    inst = simpleeval.SimpleEval()
+    inst.functions.update(functions or {})
+    inst.functions["variable"] = variable
+    parsed = inst.parse(master_operation)
+    # random functions give a new result for each period
+    reuse = "rand" not in master_operation
+    values = []
+    while current[0] < len(periods):
+        calls.clear()
+        try:
+            value = inst.eval(master_operation, previously_parsed=parsed)
+        except (TypeError, ValueError, ArithmeticError):
+            value = None
+        except MissingInput as e:
+            logger.debug(f"Value of variable {e} missing for the chunk")
+            return None
+        end = current[0] + 1
+        if reuse:
+            end = len(periods)
+            for key in calls:
+                change = inputs[key].next_change(current[0])
+                if change is not None:
+                    end = min(end, change)
+        values += [value] * (end - current[0])
+        current[0] = end
+    return values
+
+
+def evaluate_fleet(
+    template, members, periods, series, functions=None, timestamp_series=None
+):
+    """
+    evaluate a templated master operation for each member and period at once
+    variable(k) of the template refers to the k-th variable id of a member tuple
+    the functions are the NumPy implementations
+    the timestamp lookups use timestamp_series if given
+    return the list of the values of each member or None if the template cannot
+    be evaluated on arrays or if a value is missing in the series
+
+    A lookup returns a (members, periods) float array, a result is None when
+    a referenced variable has no value in the period.
+    """
+    time_mins = np.array([p[0] for p in periods], dtype=np.float64)
+    time_maxs = np.array([p[1] for p in periods], dtype=np.float64)
+    shape = (len(members), len(periods))
+    inputs = {}
+    missing = np.zeros(shape, dtype=bool)
+
+    def variable(position, use_date_saved=False, query_type="value"):
+        key = (position, query_type)
+        if key not in inputs:
+            if use_date_saved or query_type not in ["value", "timestamp"]:
+                raise MissingInput(position)
+            rows = np.empty(shape, dtype=np.float64)
+            lookup_series = series
+            if query_type == "timestamp" and timestamp_series is not None:
+                lookup_series = timestamp_series
+            for m, member in enumerate(members):
+                s = lookup_series.get(member[position], None)
+                if s is None or not series_covers(
+                    s, time_mins.min(), time_maxs.max()
+                ):
+                    raise MissingInput(member[position])
+                indices = get_last_indices(s[2], time_mins, time_maxs)
+                found = indices >= 0
+                if query_type == "timestamp":
+                    values = s[2]
+                else:
+                    found &= np.array([v is not None for v in s[3]] + [False])[indices]
+                    values = np.array(
+                        [np.nan if v is None else v for v in s[3]], dtype=np.float64
+                    )
+                rows[m] = np.where(
+                    found,
+                    values[np.maximum(indices, 0)] if len(values) else np.nan,
+                    np.nan,
+                )
+                missing[m] |= ~found
+            inputs[key] = rows
+        return inputs[key]
+
+    inst = simpleeval.SimpleEval()
+    inst.functions.update(functions or {})
+    inst.functions["variable"] = variable
+    try:
+        with np.errstate(all="ignore"):
+            result = np.asarray(inst.eval(template))
+        if result.dtype.kind not in "biuf":
+            return None
+        result = np.broadcast_to(result, shape)
+    except MissingInput as e:
+        logger.debug(f"Value of variable {e} missing for the fleet")
+        return None
+    except Exception as e:
+        # if expressions, comparisons chains, strings, ...
+        logger.debug(f"Cannot evaluate {template} on arrays : {e}")
+        return None
+    if result.dtype.kind == "f":
+        # a NaN value gives a NaN result like the evaluation of one period,
+        # the other non finite results are the errors of the scalar functions
+        nan_inputs = np.zeros(shape, dtype=bool)
+        for rows in inputs.values():
+            nan_inputs |= np.isnan(rows)
+        missing |= ~np.isfinite(result) & ~(nan_inputs & ~missing)
+    values = result.tolist()
+    for m, p in zip(*np.nonzero(missing)):
+        values[m][p] = None
+    return values
+
+
+def lttb(x, y, threshold):
+    """
+    return the indices of the points kept by the Largest-Triangle-Three-Buckets downsampling
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    if threshold < 3:
+        return np.array([0, n - 1][:threshold], dtype=int)
+    indices = np.zeros(threshold, dtype=int)
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
+        # point of the current bucket with the largest triangle
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        area = np.abs(
+            (x[a] - avg_x) * (y[range_start:range_end] - y[a])
+            - (x[a] - x[range_start:range_end]) * (avg_y - y[a])
+        )
+        a = range_start + int(np.argmax(area))
+        indices[i + 1] = a
+    indices[-1] = n - 1
+    return indices
+
+
+def downsample(data, max_points):
+    """
+    reduce a [[timestamp, value], ...] list to max_points using lttb
+    or a stride selection if the values are not numeric
+    """
+    if max_points is None or len(data) <= max_points:
+        return data
+    try:
+        indices = lttb([d[0] for d in data], [d[1] for d in data], max_points)
+    except (TypeError, ValueError):
+        indices = np.linspace(0, len(data) - 1, max_points).astype(int)
+    return [data[i] for i in indices]
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+functions of the master operations
+
+Each function has a scalar implementation used to evaluate one period and may have
+a NumPy implementation used to evaluate arrays of periods and devices (fleets).
+The functions are registered from the default set, the `pyscada.operations.functions`
+entry points and the `functions` setting.
+"""
+from __future__ import unicode_literals
+
+from django.utils.module_loading import import_string
+
+from .utils import get_setting
+
+from functools import reduce
+from importlib.metadata import entry_points
+import numpy as np
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINTS_GROUP = "pyscada.operations.functions"
+
+
+def clip(x, low, high):
+    return min(max(x, low), high)
+
+
+def where(condition, x, y):
+    return x if condition else y
+
+
+def check_interp_args(x, points):
+    # np.interp returns nan for a None x
+    if x is None or any(p is None for p in points):
+        raise TypeError("interp() argument must be a number, not 'NoneType'")
+
+
+def interp(x, *points):
+    """
+    linear interpolation of x between the (x0, y0, x1, y1, ...) points
+    """
+    check_interp_args(x, points)
+    return float(np.interp(x, points[0::2], points[1::2]))
+
+
+def interp_array(x, *points):
+    check_interp_args(x, points)
+    return np.interp(x, points[0::2], points[1::2])
+
+
+def minimum_array(*args):
+    return reduce(np.minimum, args)
+
+
+def maximum_array(*args):
+    return reduce(np.maximum, args)
+
+
+DEFAULT_FUNCTIONS = {
+    "abs": (abs, np.abs),
+    "min": (min, minimum_array),
+    "max": (max, maximum_array),
+    "round": (round, np.round),
+    "floor": (math.floor, np.floor),
+    "ceil": (math.ceil, np.ceil),
+    "sqrt": (math.sqrt, np.sqrt),
+    "exp": (math.exp, np.exp),
+    "log": (math.log, np.log),
+    "log10": (math.log10, np.log10),
+    "sin": (math.sin, np.sin),
+    "cos": (math.cos, np.cos),
+    "tan": (math.tan, np.tan),
+    "clip": (clip, np.clip),
+    "where": (where, np.where),
+    "interp": (interp, interp_array),
+}
+
+
+class FunctionRegistry(object):
+    """
+    scalar and NumPy implementations of the functions by name
+    """
+
+    def __init__(self):
+        self.scalar = {}
+        self.vector = {}
+
+    def register(self, name, scalar, vector=None):
+        self.scalar[name] = scalar
+        if vector is None:
+            # the devices using it are evaluated period by period
+            self.vector.pop(name, None)
+        else:
+            self.vector[name] = vector
+
+    def load(self, name, value):
+        """
+        register a function given by a callable, a dotted path
+        or a (scalar, vector) pair of them
+        """
+        try:
+            if isinstance(value, (list, tuple)):
+                scalar, vector = value
+            else:
+                scalar, vector = value, None
+            if isinstance(scalar, str):
+                scalar = import_string(scalar)
+            if isinstance(vector, str):
+                vector = import_string(vector)
+        except (ImportError, ValueError, TypeError) as e:
+            logger.warning(f"Cannot load the operations function {name} : {e}")
+            return
+        self.register(name, scalar, vector)
+
+    def load_entry_points(self):
+        try:
+            group = entry_points(group=ENTRY_POINTS_GROUP)
+        except TypeError:
+            # python < 3.10
+            group = entry_points().get(ENTRY_POINTS_GROUP, [])
+        for entry_point in group:
+            try:
+                value = entry_point.load()
+            except Exception as e:
+                logger.warning(
+                    f"Cannot load the operations function {entry_point.name} : {e}"
+                )
+                continue
+            self.load(entry_point.name, value)
+
+
+registry = FunctionRegistry()
+for name, (scalar, vector) in DEFAULT_FUNCTIONS.items():
+    registry.register(name, scalar, vector)
+registry.load_entry_points()
+for name, value in get_setting("functions", {}).items():
+    registry.load(name, value)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from pyscada.models import Variable
+from pyscada.operations.models import OperationsDataSource
+from pyscada.operations.budget import QueryRejected
+
+from django.core.management.base import BaseCommand
+
+from time import time
+
+
+class Command(BaseCommand):
+    help = "explain the evaluation cost of a query of operations variables"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "variable_ids", nargs="*", type=int, help="the operations variables to query"
+        )
+        parser.add_argument(
+            "--device-ids",
+            dest="device_ids",
+            nargs="+",
+            type=int,
+            default=[],
+            help="query all the variables of these operations devices",
+        )
+        parser.add_argument(
+            "--time-min",
+            dest="time_min",
+            default=None,
+            type=float,
+            help="the start of the query as unix timestamp, default to one hour ago",
+        )
+        parser.add_argument(
+            "--time-max",
+            dest="time_max",
+            default=None,
+            type=float,
+            help="the end of the query as unix timestamp, default to now",
+        )
+        parser.add_argument(
+            "--order", dest="order", default="asc", choices=["asc", "desc"]
+        )
+        parser.add_argument("--quantity", dest="quantity", default=None, type=int)
+
+    def handle(self, *args, **options):
+        variable_ids = list(options["variable_ids"])
+        variable_ids += list(
+            Variable.objects.filter(device_id__in=options["device_ids"]).values_list(
+                "id", flat=True
+            )
+        )
+        if not len(variable_ids):
+            self.stderr.write("no variable to query")
+            return
+        time_max = options["time_max"] if options["time_max"] is not None else time()
+        time_min = (
+            options["time_min"] if options["time_min"] is not None else time_max - 3600
+        )
+        try:
+            result = OperationsDataSource.objects.first().query_data(
+                quantity=options["quantity"],
+                order=options["order"],
+                variable_ids=variable_ids,
+                time_min=time_min,
+                time_max=time_max,
+                time_in_ms=False,
+                explain=True,
+            )
+        except QueryRejected as e:
+            self.stderr.write(f"query rejected : {e}")
+            return
+        # most expensive devices first
+        reports = sorted(
+            result.get("explain", {}).items(),
+            key=lambda item: item[1].get("read_time", 0)
+            + item[1].get("trigger_read_time", 0)
+            + item[1].get("eval_time", 0),
+            reverse=True,
+        )
+        for device_id, report in reports:
+            self.stdout.write(f"device {device_id} {report.pop('device')}")
+            for key, value in report.items():
+                if isinstance(value, float):
+                    value = f"{value:.4f}"
+                self.stdout.write(f"    {key}: {value}")
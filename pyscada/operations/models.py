@@ -5,6 +5,7 @@ from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django import forms
 from django.utils.timezone import now, make_aware, is_naive
+from django.apps import apps
 
 from pyscada.models import (
     DataSource,
@@ -13,49 +14,174 @@ from pyscada.models import (
     Device,
 )
 from . import PROTOCOL_ID
+from .cache import (
+    trigger_cache,
+    window_cache,
+    shared_cache,
+    boundary_cache,
+    VariableLookupTable,
+)
+from .engine import (
+    evaluate_chunk,
+    get_series_slice,
+    downsample,
+    evaluate_fleet,
+    is_stateful,
+    PeriodState,
+)
+from .encoding import encode_output
+from .coalesce import single_flight, get_query_key
+from .pushdown import get_saved_since
+from .functions import registry
+from .utils import get_setting
+from .budget import (
+    QueryRejected,
+    QueryCancelled,
+    CancelToken,
+    get_budget,
+    admission,
+)
 
+from asgiref.sync import sync_to_async
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from math import ceil
 from time import time
-from datetime import datetime, timedelta, date
+from threading import Event, Lock, local
+from datetime import datetime, timedelta, date, timezone
 from dateutil import relativedelta
 from monthdelta import monthdelta
+import numpy as np
 import simpleeval
+import asyncio
+import re
 import logging
 
 logger = logging.getLogger(__name__)
 
-global_time_min = None
-global_time_max = None
-global_time_max_excluded = True
+
+class QueryContext(local):
+    """
+    evaluation context of the current thread used by get_variable_value
+    """
+
+    time_min = None
+    time_max = None
+    time_max_excluded = True
+    lookup_table = None
+    budget = None
+    token = None
+    evaluations = 0
+    planned = 0
+    state = None
+    calls = None
+
+
+query_context = QueryContext()
+
+
+class WorkerPool(object):
+    """
+    process pool shared by the queries of a process, created on first use
+    the spawned workers import django and the functions once for all the queries
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.processes = None
+        self.lock = Lock()
+
+    def get(self, processes):
+        with self.lock:
+            if self.executor is None or self.processes != processes:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=processes, mp_context=get_context("spawn")
+                )
+                self.processes = processes
+            return self.executor
+
+    def reset(self, executor):
+        """
+        drop a broken pool, the next query creates a new one
+        """
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+worker_pool = WorkerPool()
 
 
 def get_variable_value(variable_id, use_date_saved=False, query_type="value"):
+    value = lookup_variable_value(variable_id, use_date_saved, query_type)
+    if query_context.calls is not None:
+        query_context.calls.append((variable_id, use_date_saved, query_type, value))
+    return value
+
+
+def lookup_variable_value(variable_id, use_date_saved=False, query_type="value"):
     logger.debug(
-        f"{variable_id} {global_time_min} {global_time_max} {use_date_saved} {query_type}"
+        f"{variable_id} {query_context.time_min} {query_context.time_max} {use_date_saved} {query_type}"
     )
-    kwargs = {
-        "time_min": global_time_min,
-        "time_max": global_time_max,
-        "use_date_saved": use_date_saved,
-        "time_max_excluded": global_time_max_excluded,
-    }
-    try:
-        v = Variable.objects.get(id=variable_id)
-    except Variable.DoesNotExist:
-        logger.warning(
-            f"Cannot evaluate operations device. Variable with id {variable_id} does not exist."
+    lookup_table = query_context.lookup_table
+    if lookup_table is None:
+        lookup_table = VariableLookupTable()
+    if (
+        query_type == "value"
+        and not use_date_saved
+        and query_context.time_max_excluded
+    ):
+        # the aggregated values keep the value, not the timestamp
+        found, value = lookup_table.get_aggregated_value(
+            variable_id, query_context.time_min, query_context.time_max
         )
-    else:
-        if v.query_prev_value(**kwargs):
-            logger.debug(f"prev value {v.prev_value} {kwargs}")
-            if query_type == "timestamp":
-                return v.timestamp_old
-            elif query_type == "value":
-                return v.prev_value
-            else:
-                logger.warning(f"Operation query type unknown : {query_type}")
+        if found:
+            logger.debug(f"aggregated value {value} {variable_id}")
+            return value
+    prev_value = lookup_table.get_prev_value(
+        variable_id,
+        query_context.time_min,
+        query_context.time_max,
+        query_context.time_max_excluded,
+        use_date_saved,
+    )
+    if query_context.budget is not None:
+        query_context.budget.check_reads(lookup_table.reads)
+    if prev_value is not None:
+        logger.debug(f"prev value {prev_value} {variable_id}")
+        if query_type == "timestamp":
+            return prev_value[1]
+        elif query_type == "value":
+            return prev_value[0]
+        else:
+            logger.warning(f"Operation query type unknown : {query_type}")
     return None
 
 
+def get_prev_result(default=None):
+    """
+    return the result of the previous period or default
+    without period state (trigger devices), return default
+    """
+    if query_context.state is None:
+        return default
+    return query_context.state.prev_result(default)
+
+
+def get_cumulative_sum(value):
+    """
+    return the running total of value since the start of the device
+    without period state (trigger devices), return value
+    """
+    if query_context.state is None:
+        return value
+    return query_context.state.cumsum(value)
+
+
 def validate_nonzero(value):
     if value == 0:
         raise ValidationError(
@@ -71,7 +197,10 @@ def start_from_default():
 class OperationsDataSource(models.Model):
     datasource = models.OneToOneField(DataSource, on_delete=models.CASCADE)
     inst = simpleeval.SimpleEval()
+    inst.functions.update(registry.scalar)
     inst.functions["variable"] = get_variable_value
+    inst.functions["prev"] = get_prev_result
+    inst.functions["cumsum"] = get_cumulative_sum
     parsed_devices = {}
     evaluated_devices = {}
     parsed_variables = []
@@ -172,9 +301,6 @@ class OperationsDataSource(models.Model):
         **kwargs,
     ):
         # evaluate each device
-        global global_time_min
-        global global_time_max
-        global global_time_max_excluded
         m_o = device.operationsdevice.master_operation
         if device.id not in self.parsed_devices:
             logger.debug(f"device {device} not parsed")
@@ -183,20 +309,1078 @@ class OperationsDataSource(models.Model):
         if time_in_ms:
             time_min = time_min / 1000
             time_max = time_max / 1000
-        global_time_min = time_min
-        global_time_max = time_max
-        global_time_max_excluded = time_max_excluded
+        query_context.time_min = time_min
+        query_context.time_max = time_max
+        query_context.time_max_excluded = time_max_excluded
+        query_context.evaluations += 1
         try:
             result = self.inst.eval(m_o, previously_parsed=parsed)
-        except TypeError:
+        except (TypeError, ValueError, ArithmeticError):
+            # None values or out of domain function arguments
+            result = None
+        except QueryCancelled:
+            # the caller checks stop_query before using the result
             result = None
         return result
 
+    def eval_run(self, device, time_min, time_max, previous=None):
+        """
+        evaluate a device for a period, return the value and the lookups done
+        the previous (value, lookups) is returned if its lookups resolve to the same
+        values in this period, a run of periods over idle inputs is evaluated once
+        """
+        if previous is not None:
+            query_context.time_min = time_min
+            query_context.time_max = time_max
+            query_context.time_max_excluded = True
+            try:
+                if all(
+                    lookup_variable_value(variable_id, use_date_saved, query_type)
+                    == value
+                    for variable_id, use_date_saved, query_type, value in previous[1]
+                ):
+                    return previous
+            except QueryCancelled:
+                # stopped by the next stop_query check
+                pass
+        query_context.calls = []
+        try:
+            value = self.eval_device(device, time_min=time_min, time_max=time_max)
+            return value, query_context.calls
+        finally:
+            query_context.calls = None
+
+    def get_calendar_periods(self, period_item, d1, d2, order="asc", step=1):
+        """
+        yield the (time_min, time_max) of the periods to evaluate in the valid range [d1, d2]
+        with step > 1, only one period every step periods is evaluated
+        the boundaries are generated by blocks of epoch arrays
+        """
+        if order == "asc":
+            first = period_item.index_of(d1.timestamp())
+            limit = min(d2.timestamp(), time())
+            direction = step
+        else:
+            first = period_item.index_of(d2.timestamp())
+            limit = min(d1.timestamp(), time())
+            direction = -step
+        k = 0
+        block = 64
+        while True:
+            indices = first + np.arange(k, k + block, dtype=np.int64) * direction
+            starts = period_item.get_boundaries(indices) / 1e6
+            ends = period_item.get_boundaries(indices + 1) / 1e6
+            if order == "asc":
+                # stop at the period when the next evaluated one reaches the limit
+                stops = period_item.get_boundaries(indices + step) / 1e6 >= limit
+            else:
+                stops = period_item.get_boundaries(indices - (step - 1)) / 1e6 <= limit
+            for t_from, t_to, stop in zip(starts.tolist(), ends.tolist(), stops):
+                yield (t_from, t_to)
+                if stop:
+                    return
+            k += block
+            # small first blocks for the queries with a quantity
+            block = min(block * 4, 16384)
+
+    def eval_calendar(
+        self, device, d1, d2, period_item, order="asc", quantity=None, **kwargs
+    ):
+        """
+        evaluate the device for each period of the valid range [d1, d2]
+        return the list of [period start timestamp, value] with a value
+        the completed periods are kept in the window cache for the next queries
+        """
+        processes = kwargs.pop("processes", get_setting("processes", 1))
+        step = kwargs.pop("step", 1)
+        self.check_window(device, period_item)
+        if is_stateful(device.operationsdevice.master_operation):
+            return self.eval_calendar_stateful(
+                device, d1, d2, period_item, order, quantity, step
+            )
+        window = window_cache.get_window(device)
+        window_key = window_cache.get_key(device)
+        periods = self.get_calendar_periods(period_item, d1, d2, order, step)
+        if processes > 1 and quantity is None:
+            periods = list(periods)
+            chunk_size = get_setting("chunk_size", 1000)
+            if len(periods) > chunk_size:
+                return self.eval_calendar_pool(
+                    device,
+                    periods,
+                    window,
+                    window_key,
+                    processes,
+                    chunk_size,
+                    **kwargs,
+                )
+        # random functions give a new result for each period
+        reuse = "rand" not in device.operationsdevice.master_operation
+        previous = None
+        shared = shared_cache.get(window_key)
+        if quantity is None:
+            periods = list(periods)
+            to_evaluate = [
+                p
+                for p in periods
+                if p[0] not in window and not shared_cache.lookup(shared, p[0])[0]
+            ]
+            self.prefetch_aggregated(device, to_evaluate)
+            self.prefetch_boundaries(device, to_evaluate)
+        evaluated_periods = []
+        stored = {}
+        j = 0
+
+        for t_from, t_to in periods:
+            found, evaluated_device = self.get_cached_period(window, shared, t_from)
+            if not found:
+                logger.debug(f"{order} add for {t_from} - {t_to}")
+                if reuse:
+                    previous = self.eval_run(device, t_from, t_to, previous)
+                    evaluated_device = previous[0]
+                else:
+                    evaluated_device = self.eval_device(
+                        device,
+                        time_min=t_from,
+                        time_max=t_to,
+                    )
+                if self.stop_query():
+                    break
+                if window_cache.store(window, t_from, t_to, evaluated_device):
+                    stored[t_from] = evaluated_device
+            logger.debug([t_from, evaluated_device])
+
+            if evaluated_device is not None:
+                evaluated_periods.append([t_from, evaluated_device])
+                j += 1
+            if quantity is not None and quantity <= j:
+                break
+            if self.stop_query():
+                break
+        shared_cache.publish(window_key, stored)
+        return evaluated_periods
+
+    def eval_calendar_stateful(
+        self, device, d1, d2, period_item, order="asc", quantity=None, step=1
+    ):
+        """
+        evaluate a device using prev or cumsum for each period of the range [d1, d2]
+        the periods are evaluated in one ascending pass from the last cached state
+        before the range, or from the device start
+        """
+        targets = list(self.get_calendar_periods(period_item, d1, d2, order, step))
+        # with a quantity, evaluate the periods by batches from the start of the order
+        batch_size = quantity if quantity is not None else max(len(targets), 1)
+        evaluated_periods = []
+        for i in range(0, len(targets), batch_size):
+            batch = targets[i : i + batch_size]
+            values = self.eval_stateful_periods(device, period_item, batch)
+            for t_from, t_to in batch:
+                if t_from not in values:
+                    # stopped before the end of the range
+                    return evaluated_periods
+                if values[t_from] is not None:
+                    evaluated_periods.append([t_from, values[t_from]])
+                if quantity is not None and quantity <= len(evaluated_periods):
+                    return evaluated_periods
+        return evaluated_periods
+
+    def eval_stateful_periods(self, device, period_item, targets):
+        """
+        return the {period start timestamp: value} of the target periods
+        the periods from the last state checkpoint before the first target missing
+        in the window cache are evaluated once with the state of the previous
+        period, by blocks of chunk_size periods
+        """
+        window = window_cache.get_window(device)
+        values = window_cache.get_values(window, [p[0] for p in targets])
+        missing = [p[0] for p in targets if p[0] not in values]
+        if not len(missing):
+            return values
+        checkpoints = window_cache.get_states(device)
+        i_seed, seed = checkpoints.seed(period_item.index_of(min(missing)))
+        state = PeriodState() if seed is None else PeriodState(*seed)
+        i_last = period_item.index_of(max(missing))
+        logger.debug(
+            f"Replaying {i_last - i_seed} periods of {device} to get {len(missing)} stateful periods"
+        )
+        if query_context.budget is not None:
+            query_context.budget.check_replay(i_last - i_seed)
+        block = get_setting("chunk_size", 1000)
+        missing = set(missing)
+        latest = None
+        for k in range(i_seed + 1, i_last + 1, block):
+            indices = np.arange(k, min(k + block, i_last + 1) + 1, dtype=np.int64)
+            boundaries = (period_item.get_boundaries(indices) / 1e6).tolist()
+            periods = list(zip(boundaries[:-1], boundaries[1:]))
+            self.prefetch_aggregated(device, periods)
+            self.prefetch_boundaries(device, periods)
+            for index, (t_from, t_to) in enumerate(periods, k):
+                query_context.state = state
+                try:
+                    value = self.eval_device(device, time_min=t_from, time_max=t_to)
+                finally:
+                    query_context.state = None
+                if self.stop_query():
+                    break
+                state = state.next(value)
+                if window_cache.store(window, t_from, t_to, value):
+                    checkpoints.store(index, state.snapshot())
+                    latest = (index, state.snapshot())
+                if t_from in missing:
+                    values[t_from] = value
+            if self.stop_query():
+                break
+        if latest is not None:
+            checkpoints.store(*latest, latest=True)
+        return values
+
+    def get_fleets(self, device_ids):
+        """
+        return the {device id: fleet device ids} of the calendar devices with the same
+        period whose master operations differ only in the variable ids
+        """
+        groups = {}
+        for o_d in OperationsDevice.objects.filter(
+            operations_device_id__in=device_ids, synchronisation=0
+        ):
+            if is_stateful(o_d.master_operation) or "rand" in o_d.master_operation:
+                continue
+            key = (
+                o_d.get_template()[0],
+                o_d.start_from.timestamp(),
+                o_d.period,
+                o_d.period_factor,
+            )
+            groups.setdefault(key, []).append(o_d.operations_device_id)
+        fleets = {}
+        for fleet in groups.values():
+            if len(fleet) > 1:
+                for d_id in fleet:
+                    fleets[d_id] = tuple(fleet)
+        return fleets
+
+    def eval_fleet(self, device_ids, d1, d2, period_item, order="asc", step=1):
+        """
+        evaluate the devices of a fleet for each period of the valid range [d1, d2]
+        with one evaluation on arrays of the values resolved for each period
+        return the {device id: list of [period start timestamp, value] with a value}
+        or None if the template cannot be evaluated on arrays
+        """
+        devices = list(
+            Device.objects.filter(id__in=device_ids).select_related("operationsdevice")
+        )
+        template = devices[0].operationsdevice.get_template()[0]
+        members = [d.operationsdevice.get_template()[1] for d in devices]
+        windows = [window_cache.get_window(d) for d in devices]
+        for device in devices:
+            self.check_window(device, period_item)
+        periods = list(self.get_calendar_periods(period_item, d1, d2, order, step))
+        cached = [
+            window_cache.get_values(w, [p[0] for p in periods]) for w in windows
+        ]
+        to_evaluate = [p for p in periods if any(p[0] not in c for c in cached)]
+        values = [[] for d in devices]
+        if len(to_evaluate):
+            logger.debug(
+                f"Evaluating {len(to_evaluate)} periods of {len(devices)} devices with {template}"
+            )
+            variable_ids = set(
+                v_id for d in devices for v_id in d.operationsdevice.get_variable_ids()
+            )
+            for device in devices:
+                self.prefetch_aggregated(device, to_evaluate)
+            self.prefetch_periods(variable_ids, to_evaluate)
+            try:
+                series = self.get_fleet_series(variable_ids, to_evaluate)
+                timestamp_series = None
+                if "timestamp" in template:
+                    # the aggregated values do not keep the timestamp of the value
+                    timestamp_series = self.get_fleet_series(
+                        variable_ids, to_evaluate, use_aggregation=False
+                    )
+            except QueryCancelled:
+                # the devices are evaluated one by one up to the next stop_query check,
+                # the output keeps the cached periods and the devices already evaluated
+                return None
+            query_context.evaluations += 1
+            values = evaluate_fleet(
+                template,
+                members,
+                to_evaluate,
+                series,
+                registry.vector,
+                timestamp_series,
+            )
+            if values is None:
+                return None
+        result = {}
+        for device, window, evaluated, member_values in zip(
+            devices, windows, cached, values
+        ):
+            for (t_from, t_to), value in zip(to_evaluate, member_values):
+                evaluated[t_from] = value
+                window_cache.store(window, t_from, t_to, value)
+            result[device.id] = []
+            for t_from, t_to in periods:
+                value = evaluated[t_from]
+                if value is not None:
+                    result[device.id].append([t_from, value])
+        return result
+
+    def get_fleet_series(self, variable_ids, periods, use_aggregation=True):
+        """
+        return the {variable id: series} of the referenced variables of a fleet
+        holding the value resolved in each period like for one device
+        """
+        lookup_table = query_context.lookup_table
+        series = {}
+        for v_id in variable_ids:
+            points = []
+            for t_from, t_to in periods:
+                found = False
+                if use_aggregation:
+                    found, value = lookup_table.get_aggregated_value(v_id, t_from, t_to)
+                    point = [t_from, value]
+                if not found:
+                    prev_value = lookup_table.get_prev_value(
+                        v_id, t_from, t_to, True, False
+                    )
+                    if prev_value is None:
+                        continue
+                    point = [prev_value[1], prev_value[0]]
+                points.append(point)
+            query_context.budget.check_reads(lookup_table.reads)
+            # the periods do not overlap, one sample per period gives its value
+            points.sort(key=lambda point: point[0])
+            series[v_id] = [
+                min(p[0] for p in periods),
+                max(p[1] for p in periods),
+                np.array([point[0] for point in points], dtype=np.float64),
+                [point[1] for point in points],
+            ]
+        return series
+
+    def prefetch_aggregated(self, device, periods):
+        """
+        read the values of the referenced variables in the periods from their
+        aggregation variables of type last when their periods divide the device period
+        the periods after the aggregation last check use the raw values
+        """
+        lookup_table = query_context.lookup_table
+        if (
+            lookup_table is None
+            or not len(periods)
+            or not get_setting("use_aggregation", True)
+            or not apps.is_installed("pyscada.aggregation")
+        ):
+            return
+        period = Period(
+            device.operationsdevice.start_from,
+            device.operationsdevice.period_factor,
+            device.operationsdevice.period_choices[device.operationsdevice.period][1],
+        )
+        try:
+            for v_id in set(device.operationsdevice.get_variable_ids()):
+                agg_var = self.get_aggregation_variable(v_id, period)
+                if agg_var is None:
+                    continue
+                agg_device = agg_var.aggregation_variable.device.aggregationdevice
+                logger.debug(f"Reading {v_id} values of {device} from {agg_var}")
+                lookup_table.prefetch_aggregated(
+                    v_id,
+                    agg_var.aggregation_variable_id,
+                    periods,
+                    agg_device.start_from.timestamp(),
+                    agg_var.last_check.timestamp()
+                    - agg_device.calculation_wait_offset,
+                    agg_device.timestamp_offset,
+                )
+        except QueryCancelled:
+            # stopped by the next stop_query check
+            pass
+
+    def get_aggregation_variable(self, variable_id, period):
+        """
+        return the aggregation variable of type last of a variable with the longest
+        period dividing the period or None
+        """
+        from pyscada.aggregation.models import AggregationVariable
+
+        prefix = "aggregation_variable__device__aggregationdevice__"
+        for agg_var in (
+            AggregationVariable.objects.filter(
+                variable_id=variable_id,
+                last_check__isnull=False,
+                **{
+                    f"{prefix}type": 8,
+                    f"{prefix}calculation_start_offset": 0,
+                    f"{prefix}calculation_end_offset": 0,
+                },
+            )
+            .select_related("aggregation_variable__device__aggregationdevice")
+            .order_by(f"-{prefix}period", f"-{prefix}period_factor")
+        ):
+            agg_device = agg_var.aggregation_variable.device.aggregationdevice
+            agg_period = Period(
+                agg_device.start_from,
+                agg_device.period_factor,
+                agg_device.period_choices[agg_device.period][1],
+            )
+            if agg_period.is_divisor_of(period):
+                return agg_var
+        return None
+
+    def prefetch_boundaries(self, device, periods):
+        """
+        resolve the referenced variables values of the periods with one query per variable
+        when the variables are stored in the django database, the values of the other
+        variables are read concurrently per datasource by windows of contiguous periods
+        """
+        self.prefetch_periods(device.operationsdevice.get_variable_ids(), periods)
+
+    def prefetch_periods(self, variable_ids, periods):
+        """
+        resolve the variables values of the periods, see prefetch_boundaries
+        """
+        lookup_table = query_context.lookup_table
+        if lookup_table is None or len(periods) < 2:
+            return
+        try:
+            lookup_table.prefetch_periods(
+                variable_ids,
+                periods,
+                max_range=get_setting("prefetch_range", 86400),
+                pushdown=get_setting("boundaries_pushdown", True),
+            )
+        except QueryCancelled:
+            # stopped by the next stop_query check
+            pass
+
+    def check_window(self, device, period_item):
+        """
+        drop the cached periods of a calendar device from the oldest value of its
+        referenced variables saved since the previous check, the periods ending after
+        their newest value are not cached
+        the check runs at most once every window_cache_check seconds
+        """
+        window = window_cache.get_window(device)
+        t_check = time()
+        if (
+            window.checked is not None
+            and t_check - window.checked < get_setting("window_cache_check", 10)
+        ):
+            return
+        variables = list(
+            Variable.objects.filter(id__in=device.operationsdevice.get_variable_ids())
+        )
+        if window.checked is not None:
+            # the values are saved up to window_cache_delay seconds after the check
+            t_min = get_saved_since(variables, window.checked - window_cache.delay)
+            if t_min is not None:
+                index = period_item.index_of(t_min)
+                t_from = period_item.start_of(index)
+                logger.debug(f"Values saved late for {device} since {t_from}")
+                window_cache.invalidate(device, t_from, index)
+                shared_cache.invalidate(window_cache.get_key(device), t_from)
+        timestamps = [
+            self.get_variable_element_timestamp(v, first=False) for v in variables
+        ]
+        timestamps = [t for t in timestamps if t is not None]
+        window.settled = max(timestamps) if len(timestamps) else None
+        window.checked = t_check
+
+    def get_cached_period(self, window, shared, t_from):
+        """
+        return True and the value of a completed period found in the window
+        or in the series shared by the other processes
+        """
+        found, value = window_cache.lookup(window, t_from)
+        if found:
+            return found, value
+        found, value = shared_cache.lookup(shared, t_from)
+        if found:
+            window_cache.keep(window, t_from, value)
+        return found, value
+
+    def eval_calendar_pool(
+        self,
+        device,
+        periods,
+        window,
+        window_key,
+        processes,
+        chunk_size,
+        **kwargs,
+    ):
+        """
+        evaluate the periods not in the window cache by contiguous chunks in a process pool
+        the workers get the prefetched values of the referenced variables for their chunk
+        """
+        shared = shared_cache.get(window_key)
+        evaluated = {}
+        to_evaluate = []
+        stored = {}
+        for period in periods:
+            found, value = self.get_cached_period(window, shared, period[0])
+            if found:
+                evaluated[period[0]] = value
+            else:
+                to_evaluate.append(period)
+        chunks = [
+            to_evaluate[i : i + chunk_size]
+            for i in range(0, len(to_evaluate), chunk_size)
+        ]
+        if len(chunks):
+            lookup_table = query_context.lookup_table
+            if lookup_table is None:
+                lookup_table = VariableLookupTable()
+            time_min = min(p[0] for p in to_evaluate)
+            time_max = max(p[1] for p in to_evaluate)
+            series = {}
+            variable_ids = set(device.operationsdevice.get_variable_ids())
+            try:
+                lookup_table.prefetch_multiple(variable_ids, time_min, time_max)
+                for v_id in variable_ids:
+                    series[v_id] = lookup_table.series[v_id]
+            except QueryCancelled:
+                chunks = []
+        if len(chunks):
+            logger.debug(
+                f"Evaluating {len(to_evaluate)} periods of {device} in {len(chunks)} chunks with {processes} processes"
+            )
+            executor = worker_pool.get(processes)
+            futures = []
+            try:
+                for chunk in chunks:
+                    chunk_min = min(p[0] for p in chunk)
+                    chunk_max = max(p[1] for p in chunk)
+                    futures.append(
+                        executor.submit(
+                            evaluate_chunk,
+                            device.operationsdevice.master_operation,
+                            chunk,
+                            {
+                                v_id: get_series_slice(s, chunk_min, chunk_max)
+                                for v_id, s in series.items()
+                            },
+                            registry.scalar,
+                        )
+                    )
+            except (BrokenProcessPool, RuntimeError) as e:
+                logger.warning(f"Cannot use the worker processes : {e}")
+                worker_pool.reset(executor)
+            try:
+                for i, chunk in enumerate(chunks):
+                    values = None
+                    if i < len(futures):
+                        try:
+                            values = self.wait_chunk(futures[i])
+                        except BrokenProcessPool as e:
+                            logger.warning(f"Worker processes stopped : {e}")
+                            worker_pool.reset(executor)
+                        except Exception as e:
+                            # not picklable functions or evaluation errors
+                            logger.warning(f"Chunk of {device} not evaluated : {e}")
+                    if self.stop_query():
+                        break
+                    if values is None:
+                        # some values are not prefetched or the worker failed,
+                        # evaluate the chunk here
+                        values = []
+                        previous = None
+                        for p in chunk:
+                            previous = self.eval_run(device, p[0], p[1], previous)
+                            values.append(previous[0])
+                        if self.stop_query():
+                            break
+                    for (t_from, t_to), value in zip(chunk, values):
+                        evaluated[t_from] = value
+                        if window_cache.store(window, t_from, t_to, value):
+                            stored[t_from] = value
+            finally:
+                # do not wait for the chunks of a stopped query
+                for future in futures:
+                    future.cancel()
+        shared_cache.publish(window_key, stored)
+
+        evaluated_periods = []
+        for t_from, t_to in periods:
+            if t_from not in evaluated:
+                # stopped before the end of the range
+                break
+            if evaluated[t_from] is not None:
+                evaluated_periods.append([t_from, evaluated[t_from]])
+        return evaluated_periods
+
+    def wait_chunk(self, future):
+        """
+        return the values of a chunk evaluated by a worker process
+        or None if the query stops while waiting
+        """
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except FutureTimeoutError:
+                if self.stop_query():
+                    return None
+
+    def eval_trigger(
+        self, device, time_min, time_max, order="asc", quantity=None, **kwargs
+    ):
+        """
+        evaluate the device for each interval between two values of the trigger variable
+        return the list of [interval start timestamp, value] with a value and the downsampling mode
+
+        With a quantity, only the trigger values at the end of the range (start for asc)
+        are read. The read range is widened while the quantity of values is not reached.
+        """
+        max_points = kwargs.pop("max_points", None)
+        downsampling = kwargs.pop("downsampling", None)
+        time_max_excluded = kwargs.get("time_max_excluded", False)
+        trigger_variable = device.operationsdevice.trigger
+        read_window = None
+        if quantity is not None:
+            read_window = get_setting("trigger_read_window", 3600)
+        evaluated_periods = []
+        evaluated = set()
+        mode = "none"
+        data_length = 0
+        j = 0
+
+        while True:
+            complete = read_window is None or read_window >= time_max - time_min
+            if complete:
+                read_min, read_max = time_min, time_max
+            elif order == "asc":
+                read_min, read_max = time_min, time_min + read_window
+            else:
+                read_min, read_max = time_max - read_window, time_max
+            logger.debug(
+                f"reading timestamps of trigger variable {trigger_variable} in {read_min}, {read_max}"
+            )
+            try:
+                trigger_timestamps = trigger_cache.get_timestamps(
+                    trigger_variable.id, read_min, read_max, query_context.token
+                )
+            except QueryCancelled as e:
+                logger.info(f"Query data for OperationsDataSource stopped : {e}")
+                break
+            data_length = len(trigger_timestamps)
+            logger.debug(data_length)
+            step = 1
+            if complete and quantity is None:
+                max_points, downsampling = query_context.budget.limit(
+                    data_length, max_points, downsampling
+                )
+                mode, step = self.get_downsampling(data_length, max_points, downsampling)
+            query_context.planned = int(ceil(data_length / step))
+            if complete and quantity is None:
+                indices = range(0, data_length, step)
+                if order == "desc":
+                    indices = range(data_length - 1, -1, -step)
+                periods = [
+                    (
+                        trigger_timestamps[k],
+                        trigger_timestamps[k + 1] if k + 1 < data_length else time_max,
+                    )
+                    for k in indices
+                ]
+                self.prefetch_boundaries(device, [p for p in periods if p[0] != p[1]])
+            for i in range(0, data_length, step):
+                if order == "asc":
+                    t_from = trigger_timestamps[i]
+                    if i + 1 < data_length:
+                        t_to = trigger_timestamps[i + 1]
+                    elif complete:
+                        t_to = time_max
+                    else:
+                        # the next trigger value is not read yet
+                        break
+                elif order == "desc":
+                    t_from = trigger_timestamps[data_length - i - 1]
+                    if i > 0:
+                        t_to = trigger_timestamps[data_length - i]
+                    else:
+                        t_to = time_max
+                if (t_from, t_to) in evaluated:
+                    # already evaluated before widening the read range
+                    continue
+                evaluated.add((t_from, t_to))
+                logger.debug(f"{i} {t_from} {t_to}")
+                if t_from == t_to:
+                    # Do not exclude time_max
+                    tmp_time_max_excluded = time_max_excluded
+                else:
+                    tmp_time_max_excluded = True
+                evaluated_device = self.eval_device(
+                    device,
+                    time_min=t_from,
+                    time_max=t_to,
+                    time_max_excluded=tmp_time_max_excluded,
+                )
+                if self.stop_query():
+                    return evaluated_periods, mode
+                logger.debug([t_from, evaluated_device])
+
+                if evaluated_device is not None:
+                    evaluated_periods.append([t_from, evaluated_device])
+                    j += 1
+                if quantity is not None and quantity <= j:
+                    return evaluated_periods, mode
+                if self.stop_query():
+                    return evaluated_periods, mode
+            if complete:
+                break
+            read_window *= 4
+
+        if not data_length:
+            logger.debug(
+                f"Trigger variable {trigger_variable} has no data in {time_min} - {time_max} range"
+            )
+        if mode == "lttb":
+            evaluated_periods = downsample(evaluated_periods, max_points)
+        return evaluated_periods, mode
+
+    def get_snapshot_periods(self, device, timestamps):
+        """
+        return for each timestamp the (time_min, time_max, time_max_excluded) period
+        to evaluate to get the device value at this timestamp or None
+        - calendar : period containing the timestamp
+        - trigger : interval from the last trigger value to the timestamp
+        """
+        if device.operationsdevice.synchronisation == 0:
+            period_item = device.operationsdevice.get_period()
+            indices = np.array([period_item.index_of(t) for t in timestamps], np.int64)
+            starts = (period_item.get_boundaries(indices) / 1e6).tolist()
+            ends = (period_item.get_boundaries(indices + 1) / 1e6).tolist()
+            return [
+                (t_from, t_to, True) if i >= 0 else None
+                for i, t_from, t_to in zip(indices, starts, ends)
+            ]
+        first = self.get_variable_element_timestamp(device.operationsdevice.trigger)
+        if first is None:
+            return [None for t in timestamps]
+        time_min = min(timestamps)
+        read_window = get_setting("trigger_read_window", 3600)
+        while True:
+            read_min = max(first, time_min - read_window)
+            trigger_timestamps = np.array(
+                trigger_cache.get_timestamps(
+                    device.operationsdevice.trigger_id,
+                    read_min,
+                    max(timestamps),
+                    query_context.token,
+                ),
+                dtype=np.float64,
+            )
+            # index of the last trigger value before each timestamp
+            indices = np.searchsorted(trigger_timestamps, timestamps, side="right") - 1
+            if (indices >= 0).all() or read_min <= first:
+                break
+            read_window *= 4
+        periods = []
+        for t, i in zip(timestamps, indices):
+            if i < 0:
+                periods.append(None)
+            else:
+                t_from = float(trigger_timestamps[i])
+                periods.append((t_from, t, t_from != t))
+        return periods
+
+    def eval_snapshot(self, device_variable_ids, timestamps):
+        """
+        return the {variable id: [value at each timestamp]} matrix of the variables
+        the lookups of the referenced variables of all the devices are resolved
+        with one boundaries query per referenced variable
+        """
+        lookup_table = query_context.lookup_table
+        devices = list(
+            Device.objects.filter(id__in=device_variable_ids).select_related(
+                "operationsdevice"
+            )
+        )
+        device_periods = {}
+        boundaries = {}
+        for device in devices:
+            device_periods[device.id] = self.get_snapshot_periods(device, timestamps)
+            periods = sorted(
+                set(p[:2] for p in device_periods[device.id] if p is not None and p[2])
+            )
+            if device.operationsdevice.synchronisation == 0:
+                self.prefetch_aggregated(device, periods)
+            for v_id in device.operationsdevice.get_variable_ids():
+                boundaries.setdefault(v_id, set()).update(periods)
+        if get_setting("boundaries_pushdown", True):
+            logger.debug(
+                f"Snapshot of {len(devices)} devices at {len(timestamps)} timestamps using {len(boundaries)} variables"
+            )
+            try:
+                for v_id, periods in boundaries.items():
+                    lookup_table.prefetch_boundaries(v_id, sorted(periods))
+            except QueryCancelled:
+                # stopped by the next stop_query check
+                pass
+
+        output = {}
+        for device in devices:
+            if self.stop_query():
+                break
+            periods = device_periods[device.id]
+            values = {}
+            if (
+                device.operationsdevice.synchronisation == 0
+                and is_stateful(device.operationsdevice.master_operation)
+                and any(periods)
+            ):
+                # the trigger devices have no period state, prev returns its default
+                targets = sorted(set(p[:2] for p in periods if p is not None))
+                stateful_values = self.eval_stateful_periods(
+                    device, device.operationsdevice.get_period(), targets
+                )
+                for period in periods:
+                    if period is not None:
+                        values[period] = stateful_values.get(period[0], None)
+            for period in periods:
+                if period is None or period in values:
+                    continue
+                values[period] = self.eval_device(
+                    device,
+                    time_min=period[0],
+                    time_max=period[1],
+                    time_max_excluded=period[2],
+                )
+                if self.stop_query():
+                    break
+            for v_id in device_variable_ids[device.id]:
+                output[v_id] = [values.get(period, None) for period in periods]
+        return output
+
+    def snapshot(self, variable_ids, timestamps, **kwargs):
+        """
+        return the {variable id: [value at each timestamp]} matrix of the operations
+        variables at the timestamps (in seconds), one evaluation per device and timestamp
+        """
+        return self.query_data(
+            variable_ids=variable_ids, snapshot=tuple(timestamps), **kwargs
+        )
+
     def read_multiple(self, **kwargs):
-        return self.query_data(**kwargs)
+        try:
+            return self.query_data(**kwargs)
+        except (QueryRejected, QueryCancelled):
+            # logged by query_data
+            return {}
+
+    async def aread_multiple(self, **kwargs):
+        try:
+            return await self.aquery_data(**kwargs)
+        except (QueryRejected, QueryCancelled):
+            return {}
 
     def query_data(self, quantity=None, order="asc", **kwargs):
-        t_start = time()
+        """
+        return the {variable id: list of [timestamp, value]} of the operations
+        variables, raise QueryRejected if the query is over its budget or if too many
+        queries are running and QueryCancelled if it is stopped before any output
+        """
+        if kwargs.get("output_format", None) is not None:
+            output_format = kwargs.pop("output_format")
+            return self.format_output(
+                self.query_data(quantity=quantity, order=order, **kwargs),
+                output_format,
+                kwargs.get("time_in_ms", True),
+            )
+        if (
+            not kwargs.pop("coalesced", False)
+            and query_context.lookup_table is None
+            and get_setting("coalesce_queries", True)
+        ):
+            key = get_query_key(quantity, order, kwargs)
+            if key is not None:
+                # identical concurrent queries share one evaluation
+                return single_flight.do(
+                    (self.pk, key),
+                    lambda: self.query_data(
+                        quantity=quantity, order=order, coalesced=True, **kwargs
+                    ),
+                )
+        lookup_table = kwargs.pop("lookup_table", None)
+        admitted = kwargs.pop("admitted", False)
+        token = kwargs.pop("token", None)
+        if query_context.lookup_table is not None:
+            # nested query (query_first_value), share the lookup table and the budget
+            return self.eval_query(quantity=quantity, order=order, **kwargs)
+        if not admitted and not admission.acquire():
+            logger.warning(
+                "Query data for OperationsDataSource rejected : too many concurrent queries"
+            )
+            raise QueryRejected("too many concurrent queries")
+        if lookup_table is None:
+            lookup_table = VariableLookupTable()
+        if token is None:
+            token = CancelToken(
+                timeout=kwargs.get("timeout", None), event=kwargs.get("cancel", None)
+            )
+        lookup_table.token = token
+        query_context.lookup_table = lookup_table
+        query_context.budget = get_budget(**kwargs)
+        query_context.token = token
+        try:
+            return self.eval_query(quantity=quantity, order=order, **kwargs)
+        except QueryRejected as e:
+            logger.warning(f"Query data for OperationsDataSource rejected : {e}")
+            raise
+        except QueryCancelled as e:
+            logger.info(f"Query data for OperationsDataSource stopped : {e}")
+            raise
+        finally:
+            logger.debug(f"Operations lookup table : {lookup_table}")
+            query_context.lookup_table = None
+            query_context.budget = None
+            query_context.token = None
+            if not admitted:
+                admission.release()
+
+    async def aquery_data(self, quantity=None, order="asc", **kwargs):
+        """
+        coroutine version of query_data
+
+        The trigger variables and, for a range of at most prefetch_range seconds,
+        the referenced variables are read concurrently, then the devices are evaluated
+        in a worker thread using the prefetched values. The referenced variables of
+        a longer range are read by windows during the evaluation.
+        If the coroutine is cancelled, the reads and the evaluation stop at the next
+        read slice or period.
+        """
+        if kwargs.get("output_format", None) is not None:
+            output_format = kwargs.pop("output_format")
+            return self.format_output(
+                await self.aquery_data(quantity=quantity, order=order, **kwargs),
+                output_format,
+                kwargs.get("time_in_ms", True),
+            )
+        if not kwargs.pop("coalesced", False) and get_setting("coalesce_queries", True):
+            key = get_query_key(quantity, order, kwargs)
+            if key is not None:
+                return await single_flight.ado(
+                    (self.pk, key),
+                    lambda: self.aquery_data(
+                        quantity=quantity, order=order, coalesced=True, **kwargs
+                    ),
+                )
+        variable_ids = kwargs.get("variable_ids", [])
+        time_min = kwargs.get("time_min", 0)
+        time_max = kwargs.setdefault("time_max", time())
+        lookup_table = VariableLookupTable()
+        cancel = Event()
+        token = CancelToken(timeout=kwargs.get("timeout", None), event=cancel)
+        lookup_table.token = token
+
+        if not await sync_to_async(admission.acquire, thread_sensitive=False)():
+            logger.warning(
+                "Query data for OperationsDataSource rejected : too many concurrent queries"
+            )
+            raise QueryRejected("too many concurrent queries")
+        try:
+            referenced_ids, trigger_ids = await sync_to_async(self.get_prefetch_ids)(
+                variable_ids
+            )
+            if time_max - time_min > get_setting("prefetch_range", 86400):
+                # the whole range is not kept in memory
+                referenced_ids = []
+            await asyncio.gather(
+                # one read per datasource, the datasources are read concurrently
+                sync_to_async(lookup_table.prefetch_multiple, thread_sensitive=False)(
+                    referenced_ids, time_min, time_max
+                ),
+                *[
+                    sync_to_async(trigger_cache.get_timestamps, thread_sensitive=False)(
+                        v_id, time_min, time_max, token
+                    )
+                    for v_id in trigger_ids
+                ],
+            )
+            return await sync_to_async(self.query_data, thread_sensitive=False)(
+                quantity=quantity,
+                order=order,
+                lookup_table=lookup_table,
+                token=token,
+                admitted=True,
+                **kwargs,
+            )
+        except asyncio.CancelledError:
+            cancel.set()
+            logger.info("Query data for OperationsDataSource cancelled.")
+            raise
+        except QueryCancelled as e:
+            logger.info(f"Query data for OperationsDataSource stopped : {e}")
+            raise
+        finally:
+            admission.release()
+
+    def format_output(self, output, output_format, time_in_ms=True):
+        """
+        return the output of query_data in the output format
+        "json" yields the JSON byte chunks of the output to stream them to the response
+        """
+        if output_format == "json":
+            return encode_output(
+                output,
+                time_decimals=0 if time_in_ms else 3,
+                decimals=get_setting("json_decimals", 6),
+                chunk_size=get_setting("json_chunk_size", 8192),
+            )
+        logger.warning(f"Wrong output format to query data : {output_format}")
+        return output
+
+    def get_prefetch_ids(self, variable_ids):
+        """
+        return the referenced and trigger variable ids of the variables devices
+        """
+        referenced_ids = set()
+        trigger_ids = set()
+        for var in Variable.objects.filter(id__in=variable_ids).select_related(
+            "device__operationsdevice"
+        ):
+            if not hasattr(var.device, "operationsdevice"):
+                continue
+            referenced_ids.update(var.device.operationsdevice.get_variable_ids())
+            if var.device.operationsdevice.synchronisation == 1:
+                trigger_ids.add(var.device.operationsdevice.trigger_id)
+        trigger_ids.discard(None)
+        return referenced_ids, trigger_ids
+
+    def get_downsampling(self, count, max_points=None, downsampling=None):
+        """
+        return the downsampling mode and the step to evaluate count periods with max_points
+        lttb evaluates all the periods and reduces the result,
+        stride evaluates one period every step periods
+        """
+        if max_points is None or count <= max_points:
+            return "none", 1
+        if downsampling is None:
+            if count <= max_points * get_setting("lttb_max_ratio", 10):
+                downsampling = "lttb"
+            else:
+                downsampling = "stride"
+        if downsampling == "stride":
+            return downsampling, int(ceil(count / max_points))
+        return downsampling, 1
+
+    def stop_query(self):
+        """
+        check the deadline and the cancellation of the current query
+        """
+        if query_context.token is None:
+            return False
+        reason = query_context.token.reason()
+        if reason is not None:
+            logger.info(f"Query data for OperationsDataSource stopped : {reason}")
+            return True
+        return False
+
+    def eval_query(self, quantity=None, order="asc", **kwargs):
         output = {}
         if order not in ["asc", "desc"]:
             logger.warning(f"Wrong order to query data : {order}")
@@ -211,7 +1395,14 @@ class OperationsDataSource(models.Model):
         query_first_value = (
             kwargs.pop("query_first_value") if "query_first_value" in kwargs else False
         )
-        time_max_excluded = kwargs.get("time_max_excluded", False)
+        max_points = kwargs.pop("max_points", None)
+        downsampling = kwargs.pop("downsampling", None)
+        return_downsampling = kwargs.pop("return_downsampling", False)
+        explain = {} if kwargs.pop("explain", False) else None
+        snapshot = kwargs.pop("snapshot", None)
+        if downsampling not in [None, "lttb", "stride"]:
+            logger.warning(f"Wrong downsampling to query data : {downsampling}")
+            return output
         variable_ids = self.datasource.datasource_check(
             variable_ids, items_as_id=True, ids_model=Variable
         )
@@ -220,17 +1411,42 @@ class OperationsDataSource(models.Model):
         logger.debug(f"Operations read for {variable_ids} {time_in_ms}")
 
         # parse master and sub operation
-        #self.parsed_devices = {}
+        device_variable_ids = {}
         for v_id in variable_ids:
-            self.parse_device(Variable.objects.get(id=v_id).device)
+            device = Variable.objects.get(id=v_id).device
+            if self.parse_device(device):
+                device_variable_ids.setdefault(device.id, []).append(v_id)
 
         logger.debug(self.parsed_devices)
 
+        if snapshot is not None:
+            return self.eval_snapshot(device_variable_ids, snapshot)
+
+        fleets = {}
+        fleet_periods = {}
+        if (
+            quantity is None
+            and explain is None
+            and get_setting("fleet_evaluation", True)
+        ):
+            fleets = self.get_fleets(list(device_variable_ids))
+
         # iterate over time
         self.evaluated_devices = []
-        for d_id in self.parsed_devices:
+        for d_id in device_variable_ids:
+            if self.stop_query():
+                break
             logger.debug(d_id)
             device = Device.objects.get(id=d_id)
+            mode = "none"
+            evaluated_periods = []
+            query_context.planned = 0
+            if explain is not None:
+                t_device = time()
+                lookup_stats = query_context.lookup_table.get_stats()
+                evaluations = query_context.evaluations
+                trigger_stats = [trigger_cache.hits, trigger_cache.read_time]
+                explain[d_id] = {"device": str(device), "planned_periods": 0}
             if device.operationsdevice.synchronisation == 0:
                 # calendar
                 logger.debug("calendar")
@@ -246,19 +1462,6 @@ class OperationsDataSource(models.Model):
                 )
                 d2 = datetime.fromtimestamp(time_max)
 
-                logger.debug(
-                    f"{d1} {d2} {self.period_item.period_diff_quantity(d1, d2)}"
-                )
-
-                if self.period_item.period_diff_quantity(d1, d2) is None:
-                    logger.debug(
-                        "No period in date interval : %s (%s %s)"
-                        % (self.period_item, d1, d2)
-                    )
-                    continue
-
-                td = self.period_item.add_timedelta()
-
                 d = self.period_item.get_valid_range(d1, d2)
                 if d is None:
                     logger.debug(
@@ -267,76 +1470,56 @@ class OperationsDataSource(models.Model):
                     continue
                 [d1, d2] = d
 
-                if self.period_item.period_diff_quantity(d1, d2) is None:
-                    logger.debug(
-                        "No period in new date interval : %s (%s %s)"
-                        % (self.period_item, d1, d2)
+                # the desc order also evaluates the period starting at d2
+                count = (
+                    self.period_item.index_of(d2.timestamp())
+                    - self.period_item.index_of(d1.timestamp())
+                    + (1 if order == "desc" else 0)
+                )
+                logger.debug(f"Valid range : {d1} - {d2} - {count}")
+                device_max_points, device_downsampling = query_context.budget.limit(
+                    count if quantity is None else min(count, quantity),
+                    max_points,
+                    downsampling,
+                )
+                mode, step = self.get_downsampling(
+                    count, device_max_points, device_downsampling
+                )
+                query_context.planned = int(ceil(count / step))
+                if d_id in fleets and d_id not in fleet_periods:
+                    fleet = fleets[d_id]
+                    result = self.eval_fleet(
+                        fleet, d1, d2, self.period_item, order, step
                     )
-                    continue
-
-                period_diff_quantity = self.period_item.period_diff_quantity(d1, d2)
-                logger.debug(f"Valid range : {d1} - {d2} - {period_diff_quantity}")
-
-                i = j = 0
-                stop = False
-
-                while not stop:
-                    if order == "asc":
-                        dx = d1 + i * td
-                        logger.debug("asc add for %s - %s" % (dx, dx + td))
-                        evaluated_device = self.eval_device(
-                            device,
-                            time_min=(dx).timestamp(),
-                            time_max=(dx + td).timestamp(),
-                        )
-                        if dx + td >= min(d2, now()):
-                            logger.debug(
-                                f"will stop iterating {d1} {td} {i} {d2} {now()} {d1 + (i+1)*td} {min(d2, now())}"
-                            )
-                            stop = True
-                    elif order == "desc":
-                        dx = d2 - i * td
-                        logger.debug("desc add for %s - %s" % (dx, dx + td))
-                        evaluated_device = self.eval_device(
-                            device,
-                            time_min=(dx).timestamp(),
-                            time_max=(dx + td).timestamp(),
-                        )
-                        if dx <= min(d1, now()):
-                            logger.debug(
-                                f"will stop iterating {d1} {td} {i} {d2} {now()} {d1 + (i+1)*td} {min(d2, now())}"
-                            )
-                            stop = True
-                    #                            device, time_min=(d1 + (q)).timestamp(), time_max=(d1 + td).timestamp()
-                    logger.debug([dx.timestamp(), evaluated_device])
-
-                    # eval
-                    for v_id in variable_ids:
-                        var = Variable.objects.get(id=v_id)
-                        if var.device == device:
-                            self.time_max_tmp[v_id] = time_max
-                            if v_id not in output:
-                                output[v_id] = []
-                            if evaluated_device is not None:
-                                timestamp = (
-                                    dx.timestamp() * 1000
-                                    if time_in_ms
-                                    else dx.timestamp()
-                                )
-                                logger.debug(f"append {timestamp} {evaluated_device}")
-                                output[v_id].append([timestamp, evaluated_device])
-                                self.time_max_tmp[v_id] = min(self.time_max_tmp[v_id], t_from)
-                    # d1 = d1 + td
-                    if evaluated_device is not None:
-                        j += 1
-                    if quantity is not None and quantity <= j:
-                        break
-                    i += 1
-                    if "timeout" in kwargs and kwargs["timeout"] < time() - t_start:
-                        stop = True
-                        logger.info(
-                            f"Timeout of {kwargs['timeout']} seconds reached in query data for OperationsDataSource."
-                        )
+                    if result is None:
+                        # evaluate each device of the fleet
+                        for f_id in fleet:
+                            fleets.pop(f_id, None)
+                    else:
+                        fleet_periods.update(result)
+                if d_id in fleet_periods:
+                    evaluated_periods = fleet_periods.pop(d_id)
+                else:
+                    evaluated_periods = self.eval_calendar(
+                        device,
+                        d1,
+                        d2,
+                        self.period_item,
+                        order,
+                        quantity,
+                        step=step,
+                        **kwargs,
+                    )
+                if mode == "lttb":
+                    evaluated_periods = downsample(evaluated_periods, device_max_points)
+                for v_id in device_variable_ids[d_id]:
+                    self.time_max_tmp[v_id] = time_max
+                    if v_id not in output:
+                        output[v_id] = []
+                    for t_from, evaluated_device in evaluated_periods:
+                        timestamp = t_from * 1000 if time_in_ms else t_from
+                        output[v_id].append([timestamp, evaluated_device])
+                        self.time_max_tmp[v_id] = min(self.time_max_tmp[v_id], t_from)
             if device.operationsdevice.synchronisation == 1:
                 # variable trigger
                 logger.debug("trigger")
@@ -349,97 +1532,170 @@ class OperationsDataSource(models.Model):
                         f"Trigger variable of the operations device {device} cannot be a variable using {self.__class__.__name__} as datasource"
                     )
                     continue
-                logger.debug(
-                    f"reading values of trigger variable {trigger_variable} in {time_min}, {time_max} as time_in_ms False without first value"
+                evaluated_periods, mode = self.eval_trigger(
+                    device,
+                    time_min,
+                    time_max,
+                    order,
+                    quantity,
+                    max_points=max_points,
+                    downsampling=downsampling,
+                    **kwargs,
                 )
-                trigger_data = Variable.objects.read_multiple(
-                    variable_ids=[trigger_variable.id],
-                    time_min=time_min,
-                    time_max=time_max,
-                    time_in_ms=True,
-                    query_first_value=False,
+                for v_id in device_variable_ids[d_id]:
+                    self.time_max_tmp[v_id] = time_max
+                    if v_id not in output:
+                        output[v_id] = []
+                    for t_from, evaluated_device in evaluated_periods:
+                        timestamp = t_from * 1000 if time_in_ms else t_from
+                        output[v_id].append([timestamp, evaluated_device])
+                        self.time_max_tmp[v_id] = min(self.time_max_tmp[v_id], t_from)
+            if explain is not None:
+                explain[d_id] = self.explain_device(
+                    device,
+                    t_device,
+                    lookup_stats,
+                    evaluations,
+                    trigger_stats,
+                    mode,
+                    evaluated_periods,
                 )
-                if trigger_variable.id in trigger_data:
-                    logger.debug(len(trigger_data[trigger_variable.id]))
-#                    logger.debug(trigger_data[trigger_variable.id])
-                    data_length = len(trigger_data[trigger_variable.id])
-                    j = 0
-                    for i in range(data_length):
-                        if order == "asc":
-                            t_from = trigger_data[trigger_variable.id][i][0] / 1000
-                            if i + 1 < data_length:
-                                t_to = trigger_data[trigger_variable.id][i + 1][0] / 1000
-                            else:
-                                t_to = time_max
-                        elif order == "desc":
-                            t_from = trigger_data[trigger_variable.id][
-                                data_length - i - 1
-                            ][0] / 1000
-                            if i > 0:
-                                t_to = trigger_data[trigger_variable.id][
-                                    data_length - i
-                                ][0] / 1000
-                            else:
-                                t_to = time_max
-                        logger.debug(f"{i} {t_from} {t_to}")
-                        if t_from == t_to:
-                            # Do not exclude time_max
-                            tmp_time_max_excluded = time_max_excluded
-                        else:
-                            tmp_time_max_excluded = True
-                        evaluated_device = self.eval_device(
-                            device,
-                            time_min=t_from,
-                            time_max=t_to,
-                            time_max_excluded=tmp_time_max_excluded,
-                        )
-                        logger.debug([t_from, evaluated_device])
-
-                        # eval
-                        for v_id in variable_ids:
-                            var = Variable.objects.get(id=v_id)
-                            if var.device == device:
-                                if v_id not in self.time_max_tmp:
-                                    self.time_max_tmp[v_id] = time_max
-                                if v_id not in output:
-                                    output[v_id] = []
-                                if evaluated_device is not None:
-                                    timestamp = t_from * 1000 if time_in_ms else t_from
-                                    output[v_id].append([timestamp, evaluated_device])
-                                    self.time_max_tmp[v_id] = min(self.time_max_tmp[v_id], t_from, time_max)
-                        if evaluated_device is not None:
-                            j += 1
-                        if quantity is not None and quantity <= j:
-                            break
-                        if "timeout" in kwargs and kwargs["timeout"] < time() - t_start:
-                            logger.info(
-                                f"Timeout of {kwargs['timeout']} seconds reached in query data for OperationsDataSource."
-                            )
-                            break
-                else:
-                    logger.debug(
-                        f"Trigger variable {trigger_variable} has no data in {time_min} - {time_max} range"
-                    )
-            for v_id in variable_ids:
-                var = Variable.objects.get(id=v_id)
-                if var.device == device:
-                    if query_first_value:
-                        tm = self.time_max_tmp[v_id] if v_id in self.time_max_tmp else time()
-                        last_value = self.last_value(variable=var, time_max=tm)
-                        if last_value is not None:
-                            if v_id not in output:
-                                output[v_id] = []
-                            output[v_id].insert(0, last_value)
+            for v_id in device_variable_ids[d_id]:
+                if return_downsampling:
+                    output.setdefault("downsampling", {})[v_id] = mode
+                if query_first_value:
+                    var = Variable.objects.get(id=v_id)
+                    tm = self.time_max_tmp[v_id] if v_id in self.time_max_tmp else time()
+                    last_value = self.last_value(variable=var, time_max=tm)
+                    if last_value is not None:
+                        if v_id not in output:
+                            output[v_id] = []
+                        output[v_id].insert(0, last_value)
+        if explain is not None:
+            return {"explain": explain}
         return output
 
+    def explain_device(
+        self,
+        device,
+        t_device,
+        lookup_stats,
+        evaluations,
+        trigger_stats,
+        mode,
+        evaluated_periods,
+    ):
+        """
+        return the evaluation cost of a device since the given counters
+        """
+        lookup_table = query_context.lookup_table
+        variable_reads = {}
+        for v_id, reads in lookup_table.variable_reads.items():
+            reads -= lookup_stats["variable_reads"].get(v_id, 0)
+            if reads:
+                variable_reads[v_id] = reads
+        read_time = lookup_table.read_time - lookup_stats["read_time"]
+        trigger_read_time = trigger_cache.read_time - trigger_stats[1]
+        return {
+            "device": str(device),
+            "synchronisation": device.operationsdevice.get_synchronisation_display(),
+            "planned_periods": query_context.planned,
+            "evaluations": query_context.evaluations - evaluations,
+            "variable_reads": variable_reads,
+            "lookup_hits": lookup_table.hits - lookup_stats["hits"],
+            "trigger_cache_hits": trigger_cache.hits - trigger_stats[0],
+            "read_time": read_time,
+            "trigger_read_time": trigger_read_time,
+            "eval_time": time() - t_device - read_time - trigger_read_time,
+            "output_points": len(evaluated_periods),
+            "downsampling": mode,
+        }
+
     def write_multiple(self, **kwargs):
         pass
 
     def get_first_element_timestamp(self, **kwargs):
-        pass
+        return self.get_element_timestamp(first=True, **kwargs)
 
     def get_last_element_timestamp(self, **kwargs):
-        pass
+        return self.get_element_timestamp(first=False, **kwargs)
+
+    def get_element_timestamp(self, first=True, **kwargs):
+        """
+        return the timestamp of the first or last value of operations variables
+        using the referenced or trigger variables, without evaluating the operations
+        """
+        if "variable" in kwargs:
+            variables = [kwargs.pop("variable")]
+        elif "variable_id" in kwargs:
+            variables = Variable.objects.filter(id=kwargs.pop("variable_id"))
+        elif "variable_ids" in kwargs:
+            variables = Variable.objects.filter(id__in=kwargs.pop("variable_ids"))
+        else:
+            logger.warning(
+                f"OperationsDataSource - element timestamp - missing variable in kwargs"
+            )
+            return None
+        timestamps = []
+        for variable in variables:
+            if not hasattr(variable.device, "operationsdevice"):
+                continue
+            t = self.get_device_element_timestamp(variable.device, first)
+            if t is not None:
+                timestamps.append(t)
+        if not len(timestamps):
+            return None
+        return min(timestamps) if first else max(timestamps)
+
+    def get_device_element_timestamp(self, device, first=True):
+        """
+        return the first or last period start of a device :
+        - calendar : period containing the first or last value of the referenced variables
+        - trigger : first or last value of the trigger variable
+        """
+        if device.operationsdevice.synchronisation == 1:
+            variable_ids = [device.operationsdevice.trigger_id]
+        else:
+            variable_ids = device.operationsdevice.get_variable_ids()
+        timestamps = []
+        for variable in Variable.objects.filter(id__in=set(variable_ids)):
+            t = self.get_variable_element_timestamp(variable, first)
+            if t is not None:
+                timestamps.append(t)
+        if not len(timestamps):
+            return None
+        t = min(timestamps) if first else max(timestamps)
+        if device.operationsdevice.synchronisation == 0:
+            period_item = Period(
+                device.operationsdevice.start_from,
+                device.operationsdevice.period_factor,
+                device.operationsdevice.period_choices[device.operationsdevice.period][
+                    1
+                ],
+            )
+            t = period_item.get_period_start(datetime.fromtimestamp(t)).timestamp()
+        return t
+
+    def get_variable_element_timestamp(self, variable, first=True):
+        """
+        return the timestamp of the first or last value of a variable from its datasource
+        """
+        timestamp = None
+        try:
+            datasource = variable.datasource.get_related_datasource()
+            if first:
+                timestamp = datasource.get_first_element_timestamp(variable=variable)
+            else:
+                timestamp = datasource.get_last_element_timestamp(variable=variable)
+        except (AttributeError, TypeError) as e:
+            logger.debug(f"Cannot get element timestamp of {variable} : {e}")
+        if timestamp is None and not first:
+            # the previous value before now is the last one
+            if variable.query_prev_value(time_min=0, time_max=time()):
+                timestamp = variable.timestamp_old
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        return timestamp
 
 
 class OperationsDevice(models.Model):
@@ -527,6 +1783,29 @@ class OperationsDevice(models.Model):
                 )
         return variable_ids
 
+    def get_period(self):
+        return Period(
+            self.start_from,
+            self.period_factor,
+            self.period_choices[self.period][1],
+        )
+
+    def get_template(self):
+        """
+        return the master operation with the variable ids replaced by their position
+        and the tuple of the variable ids
+        """
+        variable_ids = []
+
+        def replace(match):
+            variable_ids.append(int(match.group(1)))
+            return f"variable({len(variable_ids) - 1}"
+
+        template = re.sub(
+            r"variable\(\s*(\d+)(?=\s*[,)])", replace, self.master_operation
+        )
+        return template, tuple(variable_ids)
+
     def parent_device(self):
         try:
             return self.operations_device
@@ -577,6 +1856,26 @@ class OperationsVariable(models.Model):
             )
 
 
+# length of the periods in seconds or in months
+PERIOD_SECONDS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 604800,
+}
+PERIOD_MONTHS = {"month": 1, "year": 12}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def get_epoch_us(d):
+    """
+    return the epoch microseconds of an aware datetime
+    """
+    delta = d - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
 class Period(object):
     def __init__(self, start_from, period_factor, period_str):
         self.start_from = start_from
@@ -588,6 +1887,10 @@ class Period(object):
         return f"{self.start_from} {self.period_factor} {self.period_str}"
 
     def get_valid_range(self, d1, d2):
+        """
+        return the [start of the first period starting at or after d1,
+        start of the period containing d2] range or None without complete period
+        """
         if is_naive(d1):
             d1 = make_aware(d1)
         if is_naive(d2):
@@ -595,67 +1898,180 @@ class Period(object):
         if d2 <= d1:
             logger.warning("Use get_valid_range with d_start > d_end")
             return None
-        if self.start_from == d1:
-            logger.debug("strart from is d1")
-            d_start = 0
-        else:
-            logger.debug(f"{self.start_from} {d1} {self.period_str}")
-            logger.debug(d1 - self.start_from)
-            logger.debug((d1 - self.start_from).total_seconds())
-            # (d2 - d1).total_seconds() / 60 / 60
-            d_start = self.period_diff_quantity(self.start_from, d1)
-            logger.debug(f"strart from is not d1, it is {d_start}")
-            if d_start is not None:
-                if d_start != int(d_start):
-                    d_start = int(d_start) + 1
-                else:
-                    d_start = int(d_start)
-            else:
-                logger.debug("d_start - start_from < period_factor*period")
-                return None
-        d_end = self.period_diff_quantity(self.start_from, d2)
-        logger.debug(d_end)
-        if d_end is not None:
-            d_end = int(d_end)
-        else:
-            logger.debug("d_end - start_from < period_factor*period")
-            return None
-        if d_end <= d_start:
-            logger.debug("d_end - d_start < period_factor*period")
+        t1 = d1.timestamp()
+        i_start = max(0, self.index_of(t1))
+        if self.start_of(i_start) < t1:
+            i_start += 1
+        i_end = self.index_of(d2.timestamp())
+        if i_end <= i_start:
+            logger.debug(f"No complete period in [{d1}, {d2}] for {self}")
             return None
+        return [self.get_start(i_start), self.get_start(i_end)]
 
-        td = self.add_timedelta()
-
-        d_start = d_start / self.period_factor
-        if d_start != int(d_start):
-            d_start = int(d_start) + 1
+    def index_of(self, timestamp):
+        """
+        return the index of the period containing a timestamp, negative before the start
+        the fixed-length periods are counted in seconds since start_from
+        """
+        start = self.start_from.timestamp()
+        if self.is_fixed():
+            size = PERIOD_SECONDS[self.period_str] * self.period_factor
+            return int((timestamp - start) // size)
+        d = datetime.fromtimestamp(timestamp, self.start_from.tzinfo)
+        if self.period_str in PERIOD_SECONDS:
+            size = PERIOD_SECONDS[self.period_str] * self.period_factor
+            local = d.replace(tzinfo=None) - self.start_from.replace(tzinfo=None)
+            index = int(local.total_seconds() // size)
         else:
-            d_start = int(d_start)
+            size = PERIOD_MONTHS[self.period_str] * self.period_factor
+            d_start = self.start_from
+            index = ((d.year - d_start.year) * 12 + d.month - d_start.month) // size
+        # the day and time of the month start, clipped to the end of the shorter months,
+        # or the daylight saving time can move the start after d by one period
+        table = boundary_cache.get_table(
+            self.get_table_key(), index - 1, index + 1, self.compute_boundaries
+        )
+        if table is not None:
+            first, starts = table
+            position = np.searchsorted(starts, round(timestamp * 1000000), "right")
+            return first + int(position) - 1
+        while self.start_of(index) > timestamp:
+            index -= 1
+        while self.start_of(index + 1) <= timestamp:
+            index += 1
+        return index
+
+    def is_fixed(self):
+        """
+        return True if the periods have a fixed length in seconds :
+        the days and weeks of a timezone with daylight saving time start at the same
+        local time like the months
+        """
+        if self.period_str in ["day", "week"]:
+            return isinstance(self.start_from.tzinfo, timezone)
+        return self.period_str in PERIOD_SECONDS
 
-        d_end = d_end / self.period_factor
-        if d_end != int(d_end):
-            d_end = int(d_end) + 1
-        else:
-            d_end = int(d_end)
+    def start_of(self, index):
+        """
+        return the start timestamp of the period of an index
+        """
+        if self.is_fixed():
+            size = PERIOD_SECONDS[self.period_str] * self.period_factor
+            return self.start_from.timestamp() + index * size
+        return int(self.get_boundaries([index])[0]) / 1000000
+
+    def get_boundaries(self, indices):
+        """
+        return the starts of the periods of an array of indices in epoch microseconds
+        the periods without a fixed length are looked up in the boundary table
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.is_fixed():
+            size = PERIOD_SECONDS[self.period_str] * self.period_factor
+            return get_epoch_us(self.start_from) + indices * size * 1000000
+        if len(indices):
+            table = boundary_cache.get_table(
+                self.get_table_key(),
+                int(indices.min()),
+                int(indices.max()),
+                self.compute_boundaries,
+            )
+            if table is not None:
+                first, starts = table
+                return starts[indices - first]
+        return self.compute_boundaries(indices)
 
-        dd_start = d_start * td + self.start_from
-        dd_end = d_end * td + self.start_from
+    def get_table_key(self):
+        """
+        return the key of the boundary table of a period without a fixed length
+        """
+        return (
+            get_epoch_us(self.start_from),
+            repr(self.start_from.tzinfo),
+            self.period_str,
+            self.period_factor,
+        )
 
-        logger.debug(f"{d_start} {d_end} {dd_start} {dd_end}")
+    def compute_boundaries(self, indices):
+        """
+        return the starts of the periods without a fixed length of an array of indices
+        computed on the calendar with NumPy for the months of a fixed offset timezone
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not isinstance(self.start_from.tzinfo, timezone):
+            # the offset depends on the date
+            return np.array(
+                [get_epoch_us(self.get_start(i)) for i in indices.tolist()],
+                dtype=np.int64,
+            )
+        size = PERIOD_MONTHS[self.period_str] * self.period_factor
+        d = self.start_from
+        months = (d.year - 1970) * 12 + d.month - 1 + indices * size
+        month_starts = months.astype("datetime64[M]").astype("datetime64[D]")
+        month_days = (
+            (months + 1).astype("datetime64[M]").astype("datetime64[D]") - month_starts
+        ).astype(np.int64)
+        # same day as start_from, clipped to the end of the shorter months
+        days = month_starts.astype(np.int64) + np.minimum(d.day, month_days) - 1
+        time_of_day = (d.hour * 3600 + d.minute * 60 + d.second) * 1000000 + (
+            d.microsecond
+        )
+        offset = d.utcoffset() // timedelta(microseconds=1)
+        return days * 86400000000 + time_of_day - offset
 
-        if dd_end > d2:
-            logger.debug("%s > %s" % (dd_end, d2))
-            dd_end -= self.add_timedelta(self._period_diff_quantity(d2, dd_end))
-            logger.debug("dd_end : %s" % dd_end)
+    def get_start(self, index):
+        """
+        return the start datetime of the period of an index
+        """
+        if self.is_fixed():
+            return datetime.fromtimestamp(self.start_of(index), self.start_from.tzinfo)
+        if self.period_str in PERIOD_SECONDS:
+            # same local time
+            size = PERIOD_SECONDS[self.period_str] * self.period_factor
+            return self.start_from + timedelta(seconds=index * size)
+        size = PERIOD_MONTHS[self.period_str] * self.period_factor
+        return self.start_from + monthdelta(index * size)
+
+    def is_divisor_of(self, period):
+        """
+        return True if each start of the other period is a start of this period
+        """
+        seconds = PERIOD_SECONDS
+        months = PERIOD_MONTHS
+        if self.period_str in seconds:
+            size = seconds[self.period_str] * self.period_factor
+            if (period.start_from - self.start_from).total_seconds() % size:
+                return False
+            if period.period_str in seconds:
+                return (seconds[period.period_str] * period.period_factor) % size == 0
+            # the months start at the same time of a day
+            return 86400 % size == 0
+        if period.period_str not in months:
+            return False
+        size = months[self.period_str] * self.period_factor
+        if (months[period.period_str] * period.period_factor) % size:
+            return False
+        delta = relativedelta.relativedelta(period.start_from, self.start_from)
+        if delta != relativedelta.relativedelta(years=delta.years, months=delta.months):
+            return False
+        return (delta.years * 12 + delta.months) % size == 0
 
-        return [dd_start, dd_end]
+    def get_period_start(self, d):
+        """
+        return the start of the period containing d, start_from if d is before it
+        """
+        if is_naive(d):
+            d = make_aware(d)
+        if d <= self.start_from:
+            return self.start_from
+        return self.get_start(self.index_of(d.timestamp()))
 
     def add_timedelta(self, delta=None):
         if delta is None:
             delta = self.period_factor
         td = None
         if self.period_str == "year":
-            td = monthdelta(12) * delta
+            td = monthdelta(12 * delta)
         elif self.period_str == "month":
             td = monthdelta(delta)
         elif self.period_str == "week":
@@ -695,13 +2111,21 @@ class Period(object):
             return None
 
     def years_diff_quantity(self, d1, d2):
-        return relativedelta.relativedelta(d2, d1).years
+        return int(self.months_diff_quantity(d1, d2) / 12)
 
     def months_diff_quantity(self, d1, d2):
-        return (
-            relativedelta.relativedelta(d2, d1).months
-            + self.years_diff_quantity(d1, d2) * 12
-        )
+        """
+        return the number of whole months from d1 to d2, negative if d2 is before d1
+        the day of d1 is clipped to the end of the shorter months
+        """
+        months = (d2.year - d1.year) * 12 + d2.month - d1.month
+        if d2 < d1:
+            while d2 > d1 + monthdelta(months):
+                months += 1
+        else:
+            while d2 < d1 + monthdelta(months):
+                months -= 1
+        return months
 
     def weeks_diff_quantity(self, d1, d2):
         return self.days_diff_quantity(d1, d2) / 7
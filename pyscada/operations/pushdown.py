@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+resolution of the previous values of a variable at many period boundaries in one query
+
+The values of the variables stored by the django database datasource are in a table
+with an id made of the timestamp in ms and the variable id (id = ms * 2097152 + variable id).
+The last id before each boundary is selected with a LATERAL join on PostgreSQL and
+with a correlated subquery on the other backends (SQLite, MySQL).
+The values saved late are found by their date_saved to invalidate the cached periods.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+from django.db.models import Min
+
+from datetime import datetime, timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+# number of boundaries sent in one query, below the SQLite variables limit
+BOUNDARIES_PER_QUERY = 400
+
+
+def get_recorded_data_model(variable):
+    """
+    return the model storing the values of a variable
+    or None if the variable is not stored by the django database datasource
+    """
+    try:
+        datasource = variable.datasource.get_related_datasource()
+    except AttributeError:
+        return None
+    if datasource.__class__.__name__ != "DjangoDatabase" or not hasattr(
+        datasource, "_import_model"
+    ):
+        return None
+    try:
+        return datasource._import_model()
+    except (LookupError, AttributeError):
+        return None
+
+
+def get_boundary_id(timestamp, time_max_excluded=True):
+    """
+    return the first id after the values to select for a boundary timestamp
+    """
+    if time_max_excluded:
+        return int(timestamp * 1000) * 2097152
+    return (int(timestamp * 1000) + 1) * 2097152
+
+
+def get_boundary_sql(model, count):
+    """
+    return the query selecting the (boundary, last id before the boundary)
+    of a variable for count boundaries
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    variable_column = connection.ops.quote_name(
+        model._meta.get_field("variable").column
+    )
+    if connection.vendor == "postgresql":
+        return (
+            f"SELECT b.boundary, r.id FROM unnest(%s::bigint[]) AS b(boundary) "
+            f"CROSS JOIN LATERAL (SELECT id FROM {table} WHERE {variable_column} = %s "
+            f"AND id >= %s AND id < b.boundary ORDER BY id DESC LIMIT 1) AS r"
+        )
+    boundaries = " UNION ALL ".join(["SELECT %s AS boundary"] * count)
+    return (
+        f"SELECT b.boundary, (SELECT MAX(id) FROM {table} WHERE {variable_column} = %s "
+        f"AND id >= %s AND id < b.boundary) FROM ({boundaries}) AS b"
+    )
+
+
+def query_boundary_values(
+    variable, boundaries, time_min=0, time_max_excluded=True, token=None
+):
+    """
+    return a {boundary: [value, timestamp]} dict of the last value of a variable
+    before each boundary timestamp and after time_min
+    or None if the values cannot be queried in one query
+    the cancel token is checked before each query
+    """
+    model = get_recorded_data_model(variable)
+    if model is None:
+        return None
+    boundary_ids = {}
+    for boundary in boundaries:
+        boundary_ids[get_boundary_id(boundary, time_max_excluded)] = boundary
+    min_id = get_boundary_id(time_min)
+    ids = {}
+    keys = sorted(boundary_ids)
+    try:
+        with connection.cursor() as cursor:
+            for i in range(0, len(keys), BOUNDARIES_PER_QUERY):
+                if token is not None:
+                    token.check()
+                chunk = keys[i : i + BOUNDARIES_PER_QUERY]
+                sql = get_boundary_sql(model, len(chunk))
+                if connection.vendor == "postgresql":
+                    params = [chunk, variable.id, min_id]
+                else:
+                    params = [variable.id, min_id] + chunk
+                cursor.execute(sql, params)
+                for boundary_id, row_id in cursor.fetchall():
+                    if row_id is not None:
+                        ids[boundary_id] = row_id
+            rows = {}
+            row_ids = list(set(ids.values()))
+            for i in range(0, len(row_ids), BOUNDARIES_PER_QUERY):
+                for row in model.objects.filter(
+                    id__in=row_ids[i : i + BOUNDARIES_PER_QUERY]
+                ).select_related("variable"):
+                    rows[row.id] = [
+                        row.value(),
+                        (row.id - variable.id) / 2097152 / 1000.0,
+                    ]
+    except DatabaseError as e:
+        logger.info(f"Cannot query the boundary values of {variable} : {e}")
+        return None
+    result = {}
+    for boundary_id, boundary in boundary_ids.items():
+        result[boundary] = rows.get(ids.get(boundary_id, None), None)
+    return result
+
+
+def get_saved_since(variables, date_saved):
+    """
+    return the timestamp of the oldest value of the variables saved after the
+    date_saved timestamp, or None
+    the variables not stored by the django database datasource are skipped
+    """
+    groups = {}
+    for variable in variables:
+        model = get_recorded_data_model(variable)
+        if model is not None:
+            groups.setdefault(model, []).append(variable.id)
+    if settings.USE_TZ:
+        date_min = datetime.fromtimestamp(date_saved, timezone.utc)
+    else:
+        date_min = datetime.fromtimestamp(date_saved)
+    t_min = None
+    for model, variable_ids in groups.items():
+        try:
+            min_id = model.objects.filter(
+                variable_id__in=variable_ids, date_saved__gte=date_min
+            ).aggregate(Min("id"))["id__min"]
+        except DatabaseError as e:
+            logger.info(f"Cannot query the values saved since {date_min} : {e}")
+            continue
+        if min_id is not None:
+            t = (min_id // 2097152) / 1000.0
+            t_min = t if t_min is None else min(t_min, t)
+    return t_min
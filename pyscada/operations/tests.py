@@ -0,0 +1,761 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management import call_command
+from django.db import connection, models
+from django.test import SimpleTestCase
+
+from pyscada.models import Variable
+
+from .budget import BudgetExceeded
+from .cache import BoundaryTableCache, TriggerHistoryCache, SharedSeriesCache
+from .coalesce import SingleFlight
+from .encoding import encode_output
+from .engine import evaluate_chunk, evaluate_fleet
+from .functions import interp, interp_array, registry
+from .models import OperationsDataSource, Period, get_epoch_us
+from .pushdown import get_boundary_id, get_saved_since, query_boundary_values
+
+from dateutil import tz
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from threading import Event, Thread
+from time import sleep
+from unittest import mock
+import asyncio
+import numpy as np
+import json
+import re
+import tempfile
+
+
+def get_date(zone, value):
+    return datetime.fromisoformat(value).replace(tzinfo=tz.gettz(zone))
+
+
+class TriggerHistoryCacheTest(SimpleTestCase):
+    def get_cache(self, timestamps, max_size=100000):
+        """
+        return a cache reading the timestamps (in seconds) in the asked range
+        """
+
+        def read_values(variable_id, time_min, time_max, time_in_ms=False, token=None):
+            return [[t * 1000, 1] for t in timestamps if time_min <= t <= time_max]
+
+        patcher = mock.patch("pyscada.operations.cache.read_values", read_values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return TriggerHistoryCache(max_size=max_size)
+
+    def test_range_larger_than_cache(self):
+        timestamps = list(range(1000, 6000))
+        cache = self.get_cache(timestamps, max_size=800)
+        for time_min in [1000, 1000, 5500]:
+            # the oldest timestamps are evicted and read again
+            result = cache.get_timestamps(1, time_min, 5999)
+            self.assertEqual(len(result), 6000 - time_min)
+            self.assertTrue(result == timestamps[time_min - 1000 :])
+
+    def test_duplicated_timestamps(self):
+        timestamps = [1000, 1010, 1010, 1020]
+        cache = self.get_cache(timestamps, max_size=3)
+        self.assertEqual(cache.get_timestamps(1, 1000, 1030), timestamps)
+        # the duplicates are not split by the eviction
+        self.assertEqual(cache.get_timestamps(1, 1010, 1030), timestamps[1:])
+
+
+class EvaluateChunkTest(SimpleTestCase):
+    def test_no_value_in_chunk(self):
+        series = {1: [0, 100, np.array([]), []]}
+        self.assertEqual(
+            evaluate_chunk("variable(1) + 1", [(0, 10), (10, 20)], series),
+            [None, None],
+        )
+
+    def test_runs_of_unchanged_inputs(self):
+        series = {1: [0, 100, np.array([1.0, 2.0, 35.0]), [3, 3, 4]]}
+        periods = [(0, 10), (10, 20), (20, 30), (30, 40), (40, 50)]
+        self.assertEqual(
+            evaluate_chunk("variable(1) * 2", periods, series), [6, None, None, 8, None]
+        )
+
+
+class EvaluateFleetTest(SimpleTestCase):
+    def test_same_values_as_chunks(self):
+        timestamps = np.array([5.0, 15.0, 25.0, 35.0, 45.0])
+        series = {
+            1: [0, 100, timestamps, [1, 2, 3, 4, 5]],
+            2: [0, 100, timestamps, [10, 0, None, 5, 2]],
+            # no value in the second and fourth periods
+            3: [0, 100, np.array([5.0, 25.0, 45.0]), [4, 5, 6]],
+            4: [0, 100, timestamps, [2, 2, 2, 2, 2]],
+            5: [0, 100, timestamps, [1, float("nan"), 3, 4, 5]],
+        }
+        members = [(1, 2), (3, 4), (2, 1), (5, 4)]
+        periods = [(0, 10), (10, 20), (20, 30), (30, 40), (40, 50)]
+        for template in [
+            "variable(0) * 2 + variable(1)",
+            "variable(0) / variable(1)",
+            "max(variable(0), variable(1)) / variable(1)",
+            "variable(0, query_type='timestamp') - variable(1)",
+        ]:
+            with self.subTest(template=template):
+                values = evaluate_fleet(
+                    template, members, periods, series, registry.vector
+                )
+                self.assertEqual(
+                    self.get_comparable(values),
+                    self.get_comparable(
+                        evaluate_chunk(
+                            re.sub(
+                                r"variable\((\d)",
+                                lambda m: f"variable({member[int(m.group(1))]}",
+                                template,
+                            ),
+                            periods,
+                            series,
+                            registry.scalar,
+                        )
+                        for member in members
+                    ),
+                )
+        # division by zero, None value, no value and NaN value
+        self.assertEqual(
+            self.get_comparable(
+                evaluate_fleet(
+                    "variable(0) / variable(1)",
+                    members,
+                    periods,
+                    series,
+                    registry.vector,
+                )
+            ),
+            [
+                [0.1, None, None, 0.8, 2.5],
+                [2.0, None, 2.5, None, 3.0],
+                [10.0, 0.0, None, 1.25, 0.4],
+                [0.5, "nan", 1.5, 2.0, 2.5],
+            ],
+        )
+
+    def get_comparable(self, values):
+        # NaN is not equal to itself
+        return [["nan" if v != v else v for v in row] for row in values]
+
+
+class EncodeOutputTest(SimpleTestCase):
+    def test_same_values_as_json(self):
+        output = {
+            1: [
+                [1000.5, 1.25],
+                [1001, None],
+                [1002.125, np.float64(-3.5)],
+                [1003, np.float32(0.5)],
+                [1004, -0.000004],
+            ],
+            # booleans, too large numbers and empty series
+            2: [[1000, True], [1001, False]],
+            3: [[1000, 1e20], [1001, 1]],
+            4: [],
+            "timestamp": 1004.0,
+            "variable": {"5": {"text": "value"}},
+        }
+        for chunk_size in [1, 2, 8192]:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(
+                    json.loads(b"".join(encode_output(output, chunk_size=chunk_size))),
+                    json.loads(json.dumps(output, default=float)),
+                )
+
+
+class OperationsExplainTest(SimpleTestCase):
+    def call_command(self, result, *args):
+        patcher = mock.patch(
+            "pyscada.operations.management.commands.operations_explain."
+            "OperationsDataSource"
+        )
+        data_source = patcher.start().objects.first.return_value
+        self.addCleanup(patcher.stop)
+        if isinstance(result, Exception):
+            data_source.query_data.side_effect = result
+        else:
+            data_source.query_data.return_value = result
+        stdout, stderr = StringIO(), StringIO()
+        call_command(
+            "operations_explain",
+            *args,
+            "--time-max",
+            "3600",
+            stdout=stdout,
+            stderr=stderr,
+        )
+        return data_source.query_data, stdout.getvalue(), stderr.getvalue()
+
+    def test_report(self):
+        explain = {
+            5: {"device": "cheap", "planned_periods": 2, "read_time": 0.25},
+            6: {"device": "expensive", "planned_periods": 3, "eval_time": 1.5},
+        }
+        query_data, stdout, stderr = self.call_command({"explain": explain}, "1", "2")
+        query_data.assert_called_once_with(
+            quantity=None,
+            order="asc",
+            variable_ids=[1, 2],
+            time_min=0.0,
+            time_max=3600.0,
+            time_in_ms=False,
+            explain=True,
+        )
+        self.assertEqual(
+            stdout.splitlines(),
+            [
+                "device 6 expensive",
+                "    planned_periods: 3",
+                "    eval_time: 1.5000",
+                "device 5 cheap",
+                "    planned_periods: 2",
+                "    read_time: 0.2500",
+            ],
+        )
+        self.assertEqual(stderr, "")
+
+    def test_rejected(self):
+        query_data, stdout, stderr = self.call_command(
+            BudgetExceeded("too many periods"), "1"
+        )
+        self.assertEqual(stdout, "")
+        self.assertEqual(stderr, "query rejected : too many periods\n")
+
+    def test_no_variable(self):
+        query_data, stdout, stderr = self.call_command({})
+        query_data.assert_not_called()
+        self.assertEqual(stderr, "no variable to query\n")
+
+
+class SingleFlightTest(SimpleTestCase):
+    def run_concurrently(self, function):
+        """
+        return the results or errors of two identical calls made while the first
+        one is running
+        """
+        flight = SingleFlight()
+        release = Event()
+        calls = []
+
+        def evaluate():
+            calls.append(1)
+            release.wait(10)
+            return function()
+
+        outcomes = [None, None]
+
+        def call(position, function):
+            try:
+                outcomes[position] = flight.do("key", function)
+            except Exception as e:
+                outcomes[position] = e
+
+        leader = Thread(target=call, args=(0, evaluate))
+        leader.start()
+        while not calls:
+            sleep(0.001)
+        follower = Thread(target=call, args=(1, evaluate))
+        follower.start()
+        while not flight.coalesced:
+            sleep(0.001)
+        release.set()
+        leader.join(10)
+        follower.join(10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.flights, {})
+        return outcomes
+
+    def test_shared_result(self):
+        leader, follower = self.run_concurrently(lambda: {1: [[0, 1.5]]})
+        self.assertEqual(leader, {1: [[0, 1.5]]})
+        self.assertEqual(follower, leader)
+        # the series lists can be changed by each caller
+        self.assertIsNot(follower[1], leader[1])
+
+    def test_shared_error(self):
+        error = ValueError("query failed")
+
+        def function():
+            raise error
+
+        self.assertEqual(self.run_concurrently(function), [error, error])
+
+    def test_async_shared_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def function():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {1: [[0, 1.5]]}
+
+        async def run():
+            return await asyncio.gather(
+                flight.ado("key", function), flight.ado("key", function)
+            )
+
+        leader, follower = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(follower, leader)
+        self.assertIsNot(follower[1], leader[1])
+
+
+class InterpTest(SimpleTestCase):
+    def test_none_input(self):
+        self.assertEqual(interp(0.5, 0, 10, 1, 20), 15.0)
+        for function in (interp, interp_array):
+            with self.assertRaises(TypeError):
+                function(None, 0, 10, 1, 20)
+            with self.assertRaises(TypeError):
+                function(0.5, 0, None, 1, 20)
+
+
+class SharedSeriesCacheTest(SimpleTestCase):
+    def get_cache(self, interval=10, max_windows=100):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return SharedSeriesCache(
+            directory=directory.name, interval=interval, max_windows=max_windows
+        )
+
+    def test_value_types(self):
+        cache = self.get_cache()
+        cache.publish("key", {0: 1.5, 10: 2, 20: True, 30: None, 40: "text"})
+        series = cache.get("key")
+        self.assertEqual(series.shape[1], 4)
+        for t_from, value in [(0, 1.5), (10, 2), (20, True), (30, None)]:
+            found, result = cache.lookup(series, t_from)
+            self.assertTrue(found)
+            self.assertEqual(result, value)
+            self.assertIs(type(result), type(value))
+        self.assertEqual(cache.lookup(series, 40), (False, None))
+
+    def test_pending_periods(self):
+        cache = self.get_cache()
+        cache.publish("key", {10: 1})
+        # published at most once per interval
+        cache.publish("key", {20: 2})
+        self.assertEqual(cache.get("key").shape[1], 1)
+        cache.published_at["key"] = 0
+        cache.publish("key", {0: 0, 30: 3})
+        self.assertEqual(cache.get("key")[0].tolist(), [0, 10, 20, 30])
+
+    def test_max_windows(self):
+        cache = self.get_cache(max_windows=2)
+        for key in ["a", "b", "c"]:
+            cache.publish(key, {10: 1})
+            cache.publish(key, {20: 2})
+            cache.get(key)
+        self.assertEqual(list(cache.series), ["b", "c"])
+        self.assertEqual(list(cache.pending), ["b", "c"])
+        self.assertEqual(list(cache.published_at), ["b", "c"])
+        # the dropped windows stay published
+        self.assertEqual(cache.get("a")[0].tolist(), [10])
+
+
+class PeriodTest(SimpleTestCase):
+    """
+    the expected values are the results of the previous datetime implementation
+    of Period, except where noted
+    """
+
+    def test_period_starts(self):
+        for zone, start_from, period_factor, period_str, expected in [
+            (
+                "UTC",
+                "2023-01-31 00:00",
+                1,
+                "month",
+                ["2023-01-31 00:00", "2023-02-28 00:00", "2023-03-31 00:00"],
+            ),
+            (
+                "UTC",
+                "2020-02-29 12:00",
+                1,
+                "year",
+                ["2020-02-29 12:00", "2021-02-28 12:00", "2022-02-28 12:00"]
+                + ["2023-02-28 12:00", "2024-02-29 12:00"],
+            ),
+            (
+                "UTC",
+                "2023-08-31 00:00",
+                5,
+                "month",
+                ["2023-08-31 00:00", "2024-01-31 00:00", "2024-06-30 00:00"],
+            ),
+            # daylight saving time on 2023-03-26 and 2023-10-29
+            (
+                "Europe/Paris",
+                "2023-01-31 00:00",
+                1,
+                "month",
+                ["2023-01-31 00:00", "2023-02-28 00:00", "2023-03-31 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-03-24 00:00",
+                1,
+                "day",
+                ["2023-03-24 00:00", "2023-03-25 00:00", "2023-03-26 00:00"]
+                + ["2023-03-27 00:00", "2023-03-28 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-10-27 00:00",
+                1,
+                "day",
+                ["2023-10-27 00:00", "2023-10-28 00:00", "2023-10-29 00:00"]
+                + ["2023-10-30 00:00", "2023-10-31 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-03-13 00:00",
+                1,
+                "week",
+                ["2023-03-13 00:00", "2023-03-20 00:00", "2023-03-27 00:00"],
+            ),
+        ]:
+            with self.subTest(zone=zone, start_from=start_from, period=period_str):
+                period = Period(get_date(zone, start_from), period_factor, period_str)
+                expected = [get_date(zone, d) for d in expected]
+                indices = list(range(len(expected)))
+                self.assertEqual([period.get_start(i) for i in indices], expected)
+                self.assertEqual(
+                    period.get_boundaries(indices).tolist(),
+                    [get_epoch_us(d) for d in expected],
+                )
+                for i in indices:
+                    self.assertEqual(period.index_of(period.start_of(i)), i)
+                    self.assertEqual(period.index_of(period.start_of(i) - 0.001), i - 1)
+
+    def test_valid_range(self):
+        for zone, start_from, period_factor, period_str, d1, d2, expected in [
+            (
+                "UTC",
+                "2023-01-31 00:00",
+                1,
+                "month",
+                "2023-01-31 00:00",
+                "2023-03-31 00:00",
+                ["2023-01-31 00:00", "2023-03-31 00:00"],
+            ),
+            # the previous implementation returned 2023-02-28, before d1
+            (
+                "UTC",
+                "2023-01-31 00:00",
+                1,
+                "month",
+                "2023-03-15 00:00",
+                "2023-07-10 00:00",
+                ["2023-03-31 00:00", "2023-06-30 00:00"],
+            ),
+            # the previous implementation returned 2021-02-28, before d1
+            (
+                "UTC",
+                "2020-02-29 00:00",
+                1,
+                "year",
+                "2022-01-01 00:00",
+                "2025-03-01 00:00",
+                ["2022-02-28 00:00", "2025-02-28 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-03-20 00:00",
+                1,
+                "day",
+                "2023-03-25 12:00",
+                "2023-03-28 00:00",
+                ["2023-03-26 00:00", "2023-03-28 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-10-20 06:00",
+                1,
+                "day",
+                "2023-10-28 12:00",
+                "2023-10-31 00:00",
+                ["2023-10-29 06:00", "2023-10-30 06:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-03-06 00:00",
+                1,
+                "week",
+                "2023-03-20 12:00",
+                "2023-04-20 00:00",
+                ["2023-03-27 00:00", "2023-04-17 00:00"],
+            ),
+            (
+                "Europe/Paris",
+                "2023-10-28 00:00",
+                1,
+                "hour",
+                "2023-10-29 01:00",
+                "2023-10-29 05:00",
+                ["2023-10-29 01:00", "2023-10-29 05:00"],
+            ),
+            (
+                "UTC",
+                "2023-01-02 00:00",
+                2,
+                "week",
+                "2023-01-20 00:00",
+                "2023-03-01 00:00",
+                ["2023-01-30 00:00", "2023-02-27 00:00"],
+            ),
+        ]:
+            with self.subTest(zone=zone, start_from=start_from, d1=d1, d2=d2):
+                period = Period(get_date(zone, start_from), period_factor, period_str)
+                self.assertEqual(
+                    period.get_valid_range(get_date(zone, d1), get_date(zone, d2)),
+                    [get_date(zone, d) for d in expected],
+                )
+
+    def test_no_complete_period(self):
+        period = Period(get_date("UTC", "2023-01-31 00:00"), 1, "month")
+        for d1, d2 in [
+            ("2023-03-15 00:00", "2023-03-15 00:00"),
+            ("2023-04-15 00:00", "2023-03-15 00:00"),
+            ("2023-03-15 00:00", "2023-04-15 00:00"),
+            ("2023-03-31 00:00", "2023-04-29 00:00"),
+            ("2022-11-01 00:00", "2023-01-31 00:00"),
+        ]:
+            with self.subTest(d1=d1, d2=d2):
+                self.assertIsNone(
+                    period.get_valid_range(get_date("UTC", d1), get_date("UTC", d2))
+                )
+        # negative indices before start_from
+        for index, d in [(-1, "2022-12-31 00:00"), (-2, "2022-11-30 00:00")]:
+            t = get_date("UTC", d).timestamp()
+            self.assertEqual(period.start_of(index), t)
+            self.assertEqual(period.index_of(t), index)
+        self.assertEqual(period.index_of(get_date("UTC", "2022-12-30").timestamp()), -2)
+
+    def test_fixed_offset_boundaries(self):
+        zone = timezone(timedelta(hours=2))
+        for start_from, period_factor, period_str in [
+            ("2023-01-31 23:30", 1, "month"),
+            ("2023-05-31 00:00", 3, "month"),
+            ("2020-02-29 01:00", 1, "year"),
+        ]:
+            with self.subTest(start_from=start_from, period=period_str):
+                period = Period(
+                    datetime.fromisoformat(start_from).replace(tzinfo=zone),
+                    period_factor,
+                    period_str,
+                )
+                indices = np.arange(-30, 30)
+                # the NumPy calendar path against the datetime path
+                self.assertEqual(
+                    period.compute_boundaries(indices).tolist(),
+                    [get_epoch_us(period.get_start(i)) for i in indices.tolist()],
+                )
+                self.assertEqual(
+                    period.get_boundaries(indices).tolist(),
+                    period.compute_boundaries(indices).tolist(),
+                )
+
+    def test_calendar_periods(self):
+        def get_previous_periods(period, d1, d2, order, step):
+            """
+            the datetime loop of the previous implementation, except the end of the
+            periods : the next start instead of dx + td clipped to the shorter months
+            """
+            td = period.add_timedelta()
+            i = 0
+            while True:
+                if order == "asc":
+                    dx = d1 + i * step * td
+                    end = d1 + (i * step + 1) * td
+                    stop = dx + step * td >= d2
+                else:
+                    dx = d2 - i * step * td
+                    end = d2 - (i * step - 1) * td
+                    stop = dx - (step - 1) * td <= d1
+                yield (dx.timestamp(), end.timestamp())
+                if stop:
+                    return
+                i += 1
+
+        for zone, start_from, period_factor, period_str, d2 in [
+            ("UTC", "2023-01-01 00:00", 1, "hour", "2023-01-11 00:00"),
+            ("UTC", "2013-01-31 00:00", 1, "month", "2023-01-31 00:00"),
+            ("Europe/Paris", "2023-03-01 06:00", 1, "day", "2023-11-30 06:00"),
+            ("Europe/Paris", "2023-03-01 00:00", 15, "minute", "2023-03-04 00:00"),
+        ]:
+            period = Period(get_date(zone, start_from), period_factor, period_str)
+            d1, d2 = period.start_from, get_date(zone, d2)
+            for order in ["asc", "desc"]:
+                for step in [1, 3]:
+                    with self.subTest(period=period_str, order=order, step=step):
+                        self.assertEqual(
+                            list(
+                                OperationsDataSource().get_calendar_periods(
+                                    period, d1, d2, order, step
+                                )
+                            ),
+                            list(get_previous_periods(period, d1, d2, order, step)),
+                        )
+
+    def test_is_divisor_of(self):
+        for period, other, expected in [
+            (("2023-01-01 00:00", 1, "hour"), ("2023-01-01 00:00", 1, "day"), True),
+            (("2023-01-01 00:00", 7, "hour"), ("2023-01-01 00:00", 1, "day"), False),
+            (("2023-01-01 00:00", 1, "day"), ("2023-01-01 00:00", 1, "month"), True),
+            (("2023-01-01 00:00", 1, "day"), ("2023-01-01 06:00", 1, "month"), False),
+            (("2023-01-31 00:00", 1, "month"), ("2023-01-31 00:00", 1, "year"), True),
+            (("2023-01-01 00:00", 2, "month"), ("2023-03-01 00:00", 1, "year"), True),
+            (("2023-01-01 00:00", 2, "month"), ("2023-02-01 00:00", 1, "year"), False),
+            (("2023-01-01 00:00", 5, "month"), ("2023-01-01 00:00", 1, "year"), False),
+            (("2023-01-01 00:00", 1, "month"), ("2023-01-01 00:00", 1, "week"), False),
+            (("2023-01-01 00:00", 1, "month"), ("2023-01-15 00:00", 1, "month"), False),
+        ]:
+            with self.subTest(period=period, other=other):
+                self.assertEqual(
+                    Period(get_date("UTC", period[0]), *period[1:]).is_divisor_of(
+                        Period(get_date("UTC", other[0]), *other[1:])
+                    ),
+                    expected,
+                )
+
+
+class BoundaryTableCacheTest(SimpleTestCase):
+    def test_get_table(self):
+        compute = mock.Mock(side_effect=lambda indices: indices * 10)
+        cache = BoundaryTableCache(max_size=80, max_tables=2)
+        first, starts = cache.get_table("a", 0, 5, compute)
+        self.assertEqual(first, -12)
+        self.assertEqual(starts.tolist(), list(range(-120, 180, 10)))
+        # covered
+        self.assertIs(cache.get_table("a", 2, 17, compute)[1], starts)
+        self.assertEqual(compute.call_count, 1)
+        # extended by the missing indices only
+        compute.reset_mock()
+        first, starts = cache.get_table("a", 20, 25, compute)
+        self.assertEqual(first, -24)
+        self.assertEqual(starts.tolist(), list(range(-240, 380, 10)))
+        self.assertEqual(
+            [call.args[0].tolist() for call in compute.call_args_list],
+            [list(range(-24, -12)), list(range(18, 38))],
+        )
+        # too large, the table is kept
+        self.assertIsNone(cache.get_table("a", 0, 60, compute))
+        self.assertEqual(cache.get_table("a", 0, 5, compute)[0], -24)
+        # least recently used table dropped
+        cache.get_table("b", 0, 5, compute)
+        cache.get_table("a", 0, 5, compute)
+        cache.get_table("c", 0, 5, compute)
+        self.assertEqual(list(cache.tables), ["a", "c"])
+
+
+class BoundaryRecord(models.Model):
+    """
+    values table with the id encoding of the django database datasource
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    variable = models.ForeignKey(
+        Variable, null=True, on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    value_float64 = models.FloatField(null=True)
+    date_saved = models.DateTimeField(null=True)
+
+    class Meta:
+        app_label = "operations"
+
+    def value(self):
+        return self.value_float64
+
+
+class PushdownTest(SimpleTestCase):
+    databases = {"default"}
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(BoundaryRecord)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(BoundaryRecord)
+
+    def setUp(self):
+        BoundaryRecord.objects.all().delete()
+        values = {5: [1000.5, 1002, 1003.25, 1010], 6: [1001]}
+        for variable_id, timestamps in values.items():
+            for i, t in enumerate(timestamps):
+                BoundaryRecord.objects.create(
+                    id=int(t * 1000) * 2097152 + variable_id,
+                    variable_id=variable_id,
+                    value_float64=variable_id * 100 + i,
+                    date_saved=datetime.fromtimestamp(t + 100, timezone.utc),
+                )
+        patcher = mock.patch(
+            "pyscada.operations.pushdown.get_recorded_data_model",
+            lambda variable: BoundaryRecord,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_value(self, variable_id, time_min, boundary, time_max_excluded):
+        """
+        return the [value, timestamp] of the last value before a boundary
+        with one query for the period
+        """
+        row = (
+            BoundaryRecord.objects.filter(
+                variable_id=variable_id,
+                id__gte=get_boundary_id(time_min),
+                id__lt=get_boundary_id(boundary, time_max_excluded),
+            )
+            .order_by("-id")
+            .first()
+        )
+        if row is None:
+            return None
+        return [row.value(), (row.id - variable_id) / 2097152 / 1000.0]
+
+    def test_boundary_id(self):
+        self.assertEqual(get_boundary_id(1000.5), 1000500 * 2097152)
+        self.assertEqual(get_boundary_id(1000.5, False), 1000501 * 2097152)
+        row = BoundaryRecord.objects.get(id=1003250 * 2097152 + 5)
+        self.assertEqual(self.get_value(5, 1003, 1004, True), [row.value(), 1003.25])
+
+    def test_boundary_values(self):
+        variable = Variable(id=5)
+        boundaries = [1000, 1000.5, 1001, 1002, 1003.25, 1005, 1010, 1020]
+        for time_min in [0, 1001]:
+            for time_max_excluded in [True, False]:
+                # several queries of two boundaries
+                with mock.patch("pyscada.operations.pushdown.BOUNDARIES_PER_QUERY", 2):
+                    result = query_boundary_values(
+                        variable, boundaries, time_min, time_max_excluded
+                    )
+                with self.subTest(time_min=time_min, excluded=time_max_excluded):
+                    self.assertEqual(
+                        result,
+                        {
+                            b: self.get_value(5, time_min, b, time_max_excluded)
+                            for b in boundaries
+                        },
+                    )
+        self.assertEqual(result[1005], [502, 1003.25])
+        self.assertEqual(query_boundary_values(variable, [1000.5])[1000.5], None)
+        self.assertEqual(
+            query_boundary_values(variable, [1000.5], 0, False)[1000.5], [500, 1000.5]
+        )
+
+    def test_saved_since(self):
+        variables = [Variable(id=5), Variable(id=6)]
+        self.assertEqual(get_saved_since(variables, 1101), 1001)
+        self.assertEqual(get_saved_since(variables[:1], 1101), 1002)
+        self.assertEqual(get_saved_since(variables, 1111), None)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    """
+    read an option of the PYSCADA_OPERATIONS dictionary in the django settings
+    """
+    if hasattr(settings, "PYSCADA_OPERATIONS") and name in settings.PYSCADA_OPERATIONS:
+        return settings.PYSCADA_OPERATIONS[name]
+    return default